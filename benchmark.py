@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+
+# Telldus Price Control benchmarks
+# Runs the control loop against the stub TellStick and price API in stubs.py
+# and prints the results as JSON, so two releases can be compared with
+#   python3 benchmark.py --output bench_output.txt
+# Nothing is sent to a real TellStick. Each run works in a temporary folder
+# with its own settings.ini, devices.ini and price archive.
+
+from array import array
+from datetime import date, datetime, timedelta
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from stubs import StubPriceAPI, StubTellStick
+
+DAY_SIZES = (24, 96, 192)
+
+SETTINGS = """[APP]
+TELL_API = 127.0.0.1:1
+AUTH = Bearer benchmark
+REQUEST_TIMEOUT = 2
+COMMAND_WORKERS = {workers}
+EL_API = http://127.0.0.1:1/api/v1/prices/
+PUBLISH_HOUR = 0
+ARCHIVE = prices.db
+AREA = SE3
+MODE = fixed
+PRICE = 2.0
+RATIO = 6
+UPDATE_INTERVAL = 10
+OVERRIDE = OFF
+ON_COMMAND =
+OFF_COMMAND =
+LOGGING = 50
+"""
+
+
+def summary(samples):
+
+    # Milliseconds, sorted samples are picked by rank
+    samples = sorted(samples)
+    if not samples:
+        return {"n": 0}
+
+    def rank(share):
+        index = min(int(share * len(samples)), len(samples) - 1)
+        return round(samples[index] * 1000, 3)
+
+    return {
+        "n": len(samples),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+        "p50_ms": rank(0.50),
+        "p90_ms": rank(0.90),
+        "p99_ms": rank(0.99),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+def make_engine(pc, root, name, tellstick, price_api, devices, override="OFF"):
+
+    # PriceEngine reads its files from the working folder, so every engine
+    # gets a folder of its own
+    folder = os.path.join(root, name)
+    os.makedirs(folder)
+    os.chdir(folder)
+    app = pc.config["APP"]
+    app["TELL_API"] = tellstick.address
+    app["EL_API"] = price_api.el_api
+    app["OVERRIDE"] = override
+    with open("devices.ini", "w", encoding="utf-8") as file:
+        for index in range(1, devices + 1):
+            file.write(f"[{index}]\nNAME = Stub {index}\nMETHODS = 3\n\n")
+    return pc.PriceEngine()
+
+
+def bench_tick(pc, root, args):
+
+    # A tick with prices in the cache. "idle" is the usual tick where the
+    # devices already have the right state, "switching" sends to every
+    # device as if the state changed. "resend" is the Override/Repeat pass
+    # that reads the device states and only sends to drifted devices.
+    results = {}
+    tellstick = StubTellStick(args.devices, args.latency, args.failure_rate).start()
+    for entries in DAY_SIZES:
+        price_api = StubPriceAPI(entries).start()
+        engine = make_engine(
+            pc, root, f"tick-{entries}", tellstick, price_api, args.devices, "ON"
+        )
+        started = time.perf_counter()
+        engine.load_prices()
+        load = time.perf_counter() - started
+        engine.tick()
+        engine.resync_interval = 0
+
+        def forget():
+            engine.lastaction = ""
+            engine.lastactions = {}
+
+        result = {"first_load_ms": round(load * 1000, 3)}
+        for key, prepare, run in (
+            ("idle", None, engine.tick),
+            ("switching", forget, engine.tick),
+            ("resend", None, engine.resend),
+        ):
+            samples = []
+            for _ in range(args.ticks):
+                if prepare:
+                    prepare()
+                started = time.perf_counter()
+                run()
+                samples.append(time.perf_counter() - started)
+            result[key] = summary(samples)
+        engine.dispatcher.shutdown()
+        results[str(entries)] = result
+        price_api.stop()
+    tellstick.stop()
+    return results
+
+
+def bench_fanout(pc, root, args):
+
+    # Time to switch n devices in one dispatch
+    results = {}
+    tellstick = StubTellStick(
+        max(args.fanout), args.latency, args.failure_rate
+    ).start()
+    price_api = StubPriceAPI(24).start()
+    engine = make_engine(pc, root, "fanout", tellstick, price_api, 0)
+    for count in args.fanout:
+        commands = [(str(index), "turnOn") for index in range(1, count + 1)]
+        samples = []
+        failed = 0
+        for _ in range(args.repeats):
+            started = time.perf_counter()
+            replies = engine.send_commands(commands)
+            samples.append(time.perf_counter() - started)
+            failed += len([reply for reply in replies if not reply["ok"]])
+        result = summary(samples)
+        result["per_device_ms"] = round(result["p50_ms"] / count, 3)
+        result["failed"] = failed
+        results[str(count)] = result
+    engine.dispatcher.shutdown()
+    price_api.stop()
+    tellstick.stop()
+    return results
+
+
+def bench_gateways(pc, root, args):
+
+    # The same number of devices on one TellStick and spread over several,
+    # each gateway with a stub of its own
+    total = args.gateway_devices
+    per_gateway = max(1, total // args.gateways)
+    tellsticks = [
+        StubTellStick(total, args.latency, args.failure_rate).start()
+        for _ in range(args.gateways)
+    ]
+    price_api = StubPriceAPI(24).start()
+    names = [f"stub{index}" for index in range(1, args.gateways)]
+    for name, tellstick in zip(names, tellsticks[1:]):
+        pc.config["GATEWAY " + name] = {"TELL_API": tellstick.address}
+    engine = make_engine(pc, root, "gateways", tellsticks[0], price_api, 0)
+    for name in names:
+        pc.config.remove_section("GATEWAY " + name)
+
+    spread = []
+    for gateway in [""] + names:
+        for device in range(1, per_gateway + 1):
+            spread.append((pc.device_key(gateway, device), "turnOn"))
+    runs = {
+        f"one_gateway_{per_gateway}": [
+            (str(device), "turnOn") for device in range(1, per_gateway + 1)
+        ],
+        f"one_gateway_{len(spread)}": [
+            (str(device), "turnOn") for device in range(1, len(spread) + 1)
+        ],
+        f"{args.gateways}_gateways_{len(spread)}": spread,
+    }
+
+    results = {}
+    for key, commands in runs.items():
+        samples = []
+        failed = 0
+        for _ in range(args.repeats):
+            started = time.perf_counter()
+            replies = engine.send_commands(commands)
+            samples.append(time.perf_counter() - started)
+            failed += len([reply for reply in replies if not reply["ok"]])
+        result = summary(samples)
+        result["failed"] = failed
+        results[key] = result
+    engine.dispatcher.shutdown()
+    price_api.stop()
+    for tellstick in tellsticks:
+        tellstick.stop()
+    return results
+
+
+def bench_memory(pc, root, args):
+
+    # Memory held per day loaded through getprice: the parsed series in the
+    # price cache plus what the archive keeps in Python
+    results = {}
+    tellstick = StubTellStick(0).start()
+    for entries in DAY_SIZES:
+        price_api = StubPriceAPI(entries).start()
+        engine = make_engine(pc, root, f"memory-{entries}", tellstick, price_api, 0)
+        engine.price_cache = pc.PriceCache(size=args.days)
+        first_day = date(2024, 1, 1)
+
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for offset in range(args.days):
+            day = first_day + timedelta(offset)
+            engine.date_to_fetch = day.strftime("%Y/%m-%d")
+            engine.getprice()
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        results[str(entries)] = {
+            "days": args.days,
+            "bytes_per_day": int((after - before) / args.days),
+        }
+        engine.dispatcher.shutdown()
+        price_api.stop()
+    tellstick.stop()
+    return results
+
+
+def bench_gui(pc, root, args):
+
+    # Redraw of the price list and graph, without the Tk main loop. Needs a
+    # display, the result says why if there is none.
+    tellstick = StubTellStick(args.devices).start()
+    price_api = StubPriceAPI(96).start()
+    engine = make_engine(pc, root, "gui", tellstick, price_api, args.devices)
+    engine.load_prices()
+    try:
+        from price_control_gui import MainWindowBuilder
+
+        window = MainWindowBuilder(engine)
+    except Exception as e:
+        price_api.stop()
+        tellstick.stop()
+        return {"skipped": str(e)}
+    window.withdraw()
+    window.loaded = True
+
+    def timed(prepare):
+        samples = []
+        for _ in range(args.repeats * 10):
+            prepare()
+            started = time.perf_counter()
+            window.redraw()
+            window.update_idletasks()
+            samples.append(time.perf_counter() - started)
+        return summary(samples)
+
+    def new_day():
+        window.list_today = None
+        window.graph_today = None
+        window.graph_drawn = None
+
+    plans = [engine.plan_today, array("b", (1 - on for on in engine.plan_today))]
+
+    def new_plan():
+        plans.reverse()
+        engine.plan_today = plans[0]
+
+    results = {
+        "new_day": timed(new_day),
+        "new_plan": timed(new_plan),
+        "unchanged": timed(lambda: None),
+    }
+    window.destroy()
+    engine.dispatcher.shutdown()
+    price_api.stop()
+    tellstick.stop()
+    return results
+
+
+BENCHMARKS = {
+    "tick": bench_tick,
+    "fanout": bench_fanout,
+    "gateways": bench_gateways,
+    "memory": bench_memory,
+    "gui": bench_gui,
+}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Telldus Price Control benchmarks")
+    parser.add_argument(
+        "--only", nargs="+", choices=list(BENCHMARKS), help="benchmarks to run"
+    )
+    parser.add_argument(
+        "--devices", type=int, default=10, help="devices for the tick and GUI"
+    )
+    parser.add_argument(
+        "--fanout",
+        type=int,
+        nargs="+",
+        default=[1, 5, 10, 25, 50],
+        help="device counts for the fan-out benchmark",
+    )
+    parser.add_argument(
+        "--gateways", type=int, default=4, help="TellSticks for the gateway benchmark"
+    )
+    parser.add_argument(
+        "--gateway-devices",
+        type=int,
+        default=100,
+        help="devices spread over the gateways",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=5, help="stub TellStick latency in ms"
+    )
+    parser.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0.0,
+        help="share of stub TellStick commands that fail, 0-1",
+    )
+    parser.add_argument("--ticks", type=int, default=200, help="ticks per run")
+    parser.add_argument("--repeats", type=int, default=5, help="runs per fan-out")
+    parser.add_argument("--days", type=int, default=30, help="days for memory")
+    parser.add_argument("--workers", type=int, default=8, help="COMMAND_WORKERS")
+    parser.add_argument("--output", help="file for the results, stdout if left out")
+    args = parser.parse_args()
+    args.latency = args.latency / 1000
+
+    here = os.getcwd()
+    output = os.path.abspath(args.output) if args.output else None
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    results = {
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "devices": args.devices,
+            "latency_ms": args.latency * 1000,
+            "failure_rate": args.failure_rate,
+            "ticks": args.ticks,
+            "repeats": args.repeats,
+            "days": args.days,
+            "workers": args.workers,
+        },
+    }
+
+    with tempfile.TemporaryDirectory(prefix="price_control_bench_") as root:
+
+        # settings.ini is read when price_control is imported
+        os.chdir(root)
+        with open("settings.ini", "w", encoding="utf-8") as file:
+            file.write(SETTINGS.format(workers=args.workers))
+        import price_control as pc
+
+        results["version"] = pc.VERSION
+        for name in args.only or list(BENCHMARKS):
+            print(f"Running {name}", file=sys.stderr)
+            results[name] = BENCHMARKS[name](pc, root, args)
+        os.chdir(here)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if output:
+        with open(output, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,16 +3,26 @@
 # Telldus Price Control
 # By Conny Holm 2023
 
-import tkinter as tk
-from tkinter import ttk, Listbox, Canvas
+import argparse
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import configparser
-from datetime import datetime, date, timedelta
+import csv
+import hashlib
+from datetime import datetime, date, timedelta, timezone
+from itertools import accumulate
 import os
 import json
 import subprocess
+import sys
 import logging
+import math
+import sqlite3
+import threading
+import time
 
-import requests
 from tzlocal import get_localzone
 
 VERSION = "25.2"
@@ -27,844 +37,2578 @@ except Exception:
 logging.basicConfig(format="%(levelname)s: %(message)s", level=LOGLEVEL)
 
 
-class MainWindowBuilder(tk.Tk):
+class Metrics:
 
-    def __init__(self):
-        super().__init__()
-
-        logging.debug("Building main window")
-        # config = configparser.ConfigParser()
-        # config.read('settings.ini')
-        self.area = str(config["APP"]["AREA"])
-        self.el_api = str(config["APP"]["EL_API"])
-        self.request_timeout = int(config["APP"]["REQUEST_TIMEOUT"])
-        self.delayseconds = int(config["APP"]["UPDATE_INTERVAL"]) * 1000
-        self.tell_api = str(config["APP"]["TELL_API"])
-        self.auth = str(config["APP"]["AUTH"])
-        self.timeout = int(config["APP"]["REQUEST_TIMEOUT"])
-        self.mode = str(config["APP"]["MODE"])
-        self.override = str(config["APP"]["OVERRIDE"])
-        self.oncommand = str(config["APP"]["ON_COMMAND"])
-        self.offcommand = str(config["APP"]["OFF_COMMAND"])
-
-        self.triggerprice = 0
-        self.triggerprice_tomorrow = 0
-        self.lastaction = ""
-        self.controldevicelist = {}
-        self.pricenow = 0
-        self.scaling = 1
-        self.highestprice = 0
-        self.date_to_fetch = ""
-
-        self.tomorrows_price = ""
-        self.todays_price = ""
-
-        self.title("Telldus Price Control " + VERSION)
-
-        # Create left frame with Telldus stuff
-        self.telldus = ttk.Labelframe(self, text="Telldus")
-
-        self.api_text = ttk.Label(self.telldus, text="Tellstick IP:")
-        self.api_entry = ttk.Entry(self.telldus)
-        self.api_entry.insert(0, self.tell_api)
-
-        self.auth_text = ttk.Label(self.telldus, text="Authorization:")
-        self.auth_entry = ttk.Entry(self.telldus)
-        self.auth_entry.insert(0, self.auth)
-
-        self.device_text = ttk.Label(self.telldus, text="Device:")
-        self.devicelist_text = ttk.Label(self.telldus, text="0 devices found")
-        self.device_combo = ttk.Combobox(self.telldus, state="readonly")
-        self.device_combo.insert(0, "No devices")
-        self.device_combo["values"] = ()
-        # self.device_combo['state'] = "READONLY"
-
-        self.telldus.grid(column=0, row=0, padx=5, pady=5, ipady=5, sticky="nw")
-        self.api_text.grid(column=0, row=0, sticky="w", padx=10, pady=4)
-        self.api_entry.grid(column=1, row=0, columnspan=2, padx=10, pady=4, ipadx=20)
-        self.auth_text.grid(column=0, row=1, sticky="w", padx=10, pady=4)
-        self.auth_entry.grid(column=1, row=1, columnspan=2, padx=10, pady=4, ipadx=20)
-
-        self.devicelist_text.grid(column=1, row=3, columnspan=2, pady=12)
-
-        self.device_text.grid(column=0, row=4, sticky="w", padx=10, pady=4)
-        self.device_combo.grid(column=1, row=4, columnspan=2, padx=0, pady=4, ipadx=12)
+    # Counters, gauges and histograms for the hot paths, kept in memory and
+    # shown in the Prometheus text format. Labels are keyword arguments.
 
-        self.on = ttk.Button(self.telldus, text="Turn On", command=self.onbutton)
-        self.off = ttk.Button(self.telldus, text="Turn Off", command=self.offbutton)
-        self.on.grid(column=1, row=5, sticky="w", padx=8)
-        self.off.grid(column=1, row=6, sticky="w", padx=8)
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
 
-        self.add_btn = ttk.Button(self.telldus, text="Add", command=self.add_device)
-        self.refresh = ttk.Button(
-            self.telldus, text="Refresh", command=self.refresh_devices
-        )
-        self.add_btn.grid(column=2, row=5, sticky="e", padx=8)
-        self.refresh.grid(column=2, row=6, sticky="e", padx=8)
-
-        self.refresh_devices()
-
-        # List for prices
-        self.priceframe = ttk.Labelframe(self, text="Price list")
-        self.pricelist = Listbox(self.priceframe, height=24, width=40)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            entry = self.histograms.get(key)
+            if entry is None:
+                entry = self.histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            index = bisect_left(self.BUCKETS, seconds)
+            if index < len(self.BUCKETS):
+                entry[0][index] += 1
+            entry[1] += seconds
+            entry[2] += 1
+
+    def series(self, name, labels, value):
+        if labels:
+            text = ",".join(
+                key + "=" + json.dumps(str(label), ensure_ascii=False)
+                for key, label in labels
+            )
+            name += "{" + text + "}"
+        return f"{name} {value}"
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = dict(
+                (key, (list(entry[0]), entry[1], entry[2]))
+                for key, entry in self.histograms.items()
+            )
 
-        self.priceframe.grid(
-            column=2, row=0, padx=5, pady=5, ipady=6, rowspan=10, sticky="nw"
-        )
-        self.pricelist.grid(column=0, row=0, padx=4, pady=4)
-
-        # Scroll bar for price list
-        self.scrollbar = ttk.Scrollbar(self)
-        self.pricelist.config(yscrollcommand=self.scrollbar.set)
-        self.scrollbar.config(command=self.pricelist.yview)
-        self.scrollbar.grid(column=2, row=0, rowspan=48, sticky="nse")
-
-        # Price control
-        self.avgpriceframe = ttk.Labelframe(self, text="Price control")
-        self.arealabel = ttk.Label(self.avgpriceframe, text="Price area:")
-        self.areatext = ttk.Label(self.avgpriceframe, text="Unknown")
-        self.avgpricelabel = ttk.Label(self.avgpriceframe, text="Todays avg price:")
-        self.avgpricecalc = ttk.Label(self.avgpriceframe, text="Unknown")
-
-        self.avgpriceframe.grid(
-            column=3,
-            row=4,
-            padx=5,
-            pady=9,
-            ipady=10,
-            sticky="nw",
-            columnspan=1,
-            rowspan=6,
-        )
-        self.arealabel.grid(column=0, row=0, padx=2, pady=0, sticky="w")
-        self.areatext.grid(column=1, row=0, padx=2, pady=0, sticky="w")
-        self.avgpricelabel.grid(column=0, row=1, padx=10, pady=0, sticky="w")
-        self.avgpricecalc.grid(column=1, row=1, padx=10, pady=0, sticky="w")
-
-        # Radiobuttons
-
-        self.controltype = tk.StringVar(None, str(config["APP"]["MODE"]))
-        self.pricefixed = ttk.Radiobutton(
-            self.avgpriceframe,
-            text="Fixed price",
-            variable=self.controltype,
-            value="fixed",
-            command=self.fixedprice,
-        )
-        self.priceratio = ttk.Radiobutton(
-            self.avgpriceframe,
-            text="Best hours",
-            variable=self.controltype,
-            value="ratio",
-            command=self.ratioprice,
-        )
+        lines = []
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            typed = set()
+            for (name, labels), value in sorted(values.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} {kind}")
+                    typed.add(name)
+                lines.append(self.series(name, labels, value))
+
+        typed = set()
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, bucket in zip(self.BUCKETS, buckets):
+                cumulative += bucket
+                bucket_labels = labels + (("le", str(bound)),)
+                lines.append(self.series(name + "_bucket", bucket_labels, cumulative))
+            bucket_labels = labels + (("le", "+Inf"),)
+            lines.append(self.series(name + "_bucket", bucket_labels, count))
+            lines.append(self.series(name + "_sum", labels, round(total, 6)))
+            lines.append(self.series(name + "_count", labels, count))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class PriceSeries:
+
+    # One day of prices, parsed once when the day is loaded. Start and end
+    # times are kept as epoch seconds in compact arrays, so finding the
+    # current interval is a bisect and DST days with 92 or 100 quarters need
+    # no special handling.
+
+    __slots__ = ("starts", "ends", "prices", "labels", "lowest", "highest", "average")
+
+    def __init__(self, entries):
+        self.starts = array("d")
+        self.ends = array("d")
+        self.prices = array("d")
+        self.labels = []
+
+        rows = []
+        for hour in entries:
+            time_start = datetime.fromisoformat(hour["time_start"])
+            time_end = datetime.fromisoformat(hour["time_end"])
+            rows.append((time_start, time_end, float(hour["SEK_per_kWh"])))
+        rows.sort(key=lambda row: row[0])
 
-        self.pricefixed.grid(column=0, row=2, padx=1, pady=0, sticky="w")
-        self.priceratio.grid(column=0, row=3, padx=1, pady=0, sticky="w")
-
-        # Spinboxes
-        self.pricefixed_val = tk.StringVar(None, str(config["APP"]["PRICE"]))
-        self.setfixed = ttk.Spinbox(
-            self.avgpriceframe,
-            from_=0.05,
-            to=99.0,
-            textvariable=self.pricefixed_val,
-            increment=0.05,
-            command=self.fixedprice,
-        )
-        self.priceratio_val = tk.StringVar(None, str(config["APP"]["RATIO"]))
-        self.setratio = ttk.Spinbox(
-            self.avgpriceframe,
-            from_=1,
-            to=23,
-            textvariable=self.priceratio_val,
-            increment=1,
-            command=self.ratioprice,
-        )
+        for time_start, time_end, price in rows:
+            self.starts.append(time_start.timestamp())
+            self.ends.append(time_end.timestamp())
+            self.prices.append(price)
+            # this is just for printing the list nicely
+            self.labels.append(time_start.strftime("%Y-%m-%d    %H:%M"))
 
-        self.setfixed.grid(column=1, row=2, sticky="e", ipadx=2)
-        self.setratio.grid(column=1, row=3, sticky="e", ipadx=2)
-
-        # checkbox for override
-        self.checkoverride_val = tk.StringVar(None, self.override)
-        self.checkoverride = tk.Checkbutton(
-            self.avgpriceframe,
-            text="Override/Repeat",
-            variable=self.checkoverride_val,
-            onvalue="ON",
-            offvalue="OFF",
+        if self.prices:
+            self.lowest = min(self.prices)
+            self.highest = max(self.prices)
+            self.average = sum(self.prices) / len(self.prices)
+        else:
+            self.lowest = self.highest = self.average = 0
+
+    def __len__(self):
+        return len(self.prices)
+
+    def index_at(self, timestamp):
+        index = bisect_right(self.starts, timestamp) - 1
+        if index >= 0 and timestamp < self.ends[index]:
+            return index
+        return None
+
+    def price_at(self, timestamp):
+        index = self.index_at(timestamp)
+        if index is None:
+            return None
+        return self.prices[index]
+
+    def next_boundary(self, timestamp):
+
+        # The first interval start or end after timestamp, or None
+        index = bisect_right(self.starts, timestamp)
+        boundary = None
+        if index > 0 and self.ends[index - 1] > timestamp:
+            boundary = self.ends[index - 1]
+        if index < len(self.starts):
+            if boundary is None or self.starts[index] < boundary:
+                boundary = self.starts[index]
+        return boundary
+
+
+class Policy:
+
+    # How devices are controlled. mode is "fixed" (on below price), "ratio"
+    # (on the cheapest ratio hours of the day) or "block" (on the cheapest
+    # ratio hours in one go). min_on is the shortest time in minutes devices
+    # stay on once switched on and max_switches the most times a day they are
+    # switched on, 0 means no limit. area is the price area, None for the
+    # AREA setting.
+
+    __slots__ = ("mode", "price", "ratio", "min_on", "max_switches", "area")
+
+    def __init__(self, mode, price, ratio, min_on=0, max_switches=0, area=None):
+        self.mode = mode
+        self.price = price
+        self.ratio = ratio
+        self.min_on = min_on
+        self.max_switches = max_switches
+        self.area = area
+
+    def key(self):
+        return (
+            self.mode,
+            self.price,
+            self.ratio,
+            self.min_on,
+            self.max_switches,
+            self.area,
         )
-        self.checkoverride.grid(column=0, row=4, sticky="w", padx=7, pady=4)
-
-        # Last updated
-        self.lastholder = ttk.Frame(self)
-        self.lastupdate = ttk.Label(self.lastholder, text="Last update: N/A")
-        self.lastholder.grid(column=4, row=6, padx=5, pady=0, sticky="nw", columnspan=1)
-        self.lastupdate.grid(column=0, row=0, padx=0, pady=0, sticky="nw")
-
-        # Last action
-        self.lastaction_label = ttk.Label(self.lastholder, text="Last action: N/A")
-        self.lastaction_label.grid(column=0, row=1, padx=0, pady=0, sticky="nw")
 
-        self.lastupdate["text"] = datetime.strftime(
-            datetime.now(), "Last update: %H:%M:%S"
-        )
-        self.lastupdate.after(self.delayseconds, self.timer_loop)
+    def label(self):
+        if self.mode == "fixed":
+            return f"fixed {self.price}"
+        text = f"{self.mode} {self.ratio}"
+        if self.mode == "ratio" and self.min_on:
+            text += f" min_on {self.min_on}"
+        if self.mode == "ratio" and self.max_switches:
+            text += f" max_switches {self.max_switches}"
+        return text
+
+
+class Planner:
+
+    # Works out the on/off plan for a whole price day at once, when the
+    # prices or the policy change. Plans are cached, so a tick only has to
+    # look up the current interval.
+
+    def __init__(self, size=16):
+        self.size = size
+        self.plans = OrderedDict()
+        self.lock = threading.Lock()
+
+    def plan(self, series, policy):
+        key = (series, policy.key())
+        with self.lock:
+            if key in self.plans:
+                self.plans.move_to_end(key)
+                metrics.inc("price_control_plan_cache_requests_total", result="hit")
+                return self.plans[key]
+        metrics.inc("price_control_plan_cache_requests_total", result="miss")
+
+        plan = self.make_plan(series, policy)
+
+        with self.lock:
+            self.plans[key] = plan
+            while len(self.plans) > self.size:
+                self.plans.popitem(last=False)
+        return plan
+
+    def make_plan(self, series, policy):
+        prices = series.prices
+        if policy.mode == "fixed":
+            return array("b", [price < policy.price for price in prices])
+        if not prices:
+            return array("b")
+        return self.ratio_plan(prices, series.ends[0] - series.starts[0], policy)
+
+    def ratio_plan(self, prices, interval, policy):
+
+        # hours are turned into a number of entries from the length of an
+        # entry, so quarter hours and DST days give the right on-time
+        count = min(len(prices), max(0, round(policy.ratio * 3600 / interval)))
+        if policy.mode == "block":
+            return self.cheapest_block(prices, count)
+
+        min_run = max(1, math.ceil(policy.min_on * 60 / interval))
+        if min_run == 1 and not policy.max_switches:
+            return self.cheapest(prices, count)
+
+        plan = self.constrained(prices, count, min_run, policy.max_switches)
+        if plan is None:
+            logging.warning("No plan fits MIN_ON and MAX_SWITCHES, using best hours")
+            return self.cheapest(prices, count)
+        return plan
+
+    def cheapest(self, prices, count):
+
+        # ties go to the earlier entry, so exactly count entries are on
+        order = sorted(range(len(prices)), key=lambda index: (prices[index], index))
+        plan = array("b", bytes(len(prices)))
+        for index in order[:count]:
+            plan[index] = 1
+        return plan
+
+    def cheapest_block(self, prices, count):
+
+        # sliding window over the day, keeping the cheapest window
+        plan = array("b", bytes(len(prices)))
+        if count == 0:
+            return plan
+        window = sum(prices[:count])
+        best, best_start = window, 0
+        for start in range(1, len(prices) - count + 1):
+            window += prices[start + count - 1] - prices[start - 1]
+            if window < best:
+                best, best_start = window, start
+        for index in range(best_start, best_start + count):
+            plan[index] = 1
+        return plan
+
+    def constrained(self, prices, count, min_run, max_runs):
+
+        # Dynamic programming over the day. A state is (entries on so far,
+        # runs started so far, length of the current run capped at min_run),
+        # where a run length of 0 means off. Only the cheapest way to reach
+        # each state is kept. Returns None if no plan fits.
+        plan = array("b", bytes(len(prices)))
+        if count == 0:
+            return plan
+
+        states = {(0, 0, 0): 0.0}
+        history = []
+        for price in prices:
+            next_states = {}
+            parents = {}
+            for state, cost in states.items():
+                on, runs, run = state
+                moves = []
+                if run == 0 or run == min_run:
+                    moves.append(((on, runs, 0), cost))
+                if on < count:
+                    if run > 0:
+                        longer = min(run + 1, min_run)
+                        moves.append(((on + 1, runs, longer), cost + price))
+                    elif not max_runs or runs < max_runs:
+                        # runs are only counted when there is a limit
+                        started = runs + 1 if max_runs else 0
+                        moves.append(((on + 1, started, 1), cost + price))
+                for new_state, new_cost in moves:
+                    if new_cost < next_states.get(new_state, math.inf):
+                        next_states[new_state] = new_cost
+                        parents[new_state] = state
+            history.append(parents)
+            states = next_states
+
+        best = None
+        for state, cost in states.items():
+            on, runs, run = state
+            if on == count and (run == 0 or run == min_run):
+                if best is None or cost < states[best]:
+                    best = state
+        if best is None:
+            return None
+
+        state = best
+        for index in range(len(prices) - 1, -1, -1):
+            if state[2] > 0:
+                plan[index] = 1
+            state = history[index][state]
+        return plan
+
+
+class PriceCache:
+
+    # Price days kept in memory as PriceSeries, keyed by (date, area), so a
+    # tick does not have to read and parse them from the archive again. The
+    # archive drops a day when it is written, and only the most recently used
+    # days are kept.
+
+    def __init__(self, size=4):
+        self.size = size
+        self.days = OrderedDict()
+
+    def get(self, key):
+        series = self.days.get(key)
+        if series is None:
+            metrics.inc("price_control_price_cache_requests_total", result="miss")
+            return None
+        self.days.move_to_end(key)
+        metrics.inc("price_control_price_cache_requests_total", result="hit")
+        return series
+
+    def put(self, key, series):
+        self.days[key] = series
+        self.days.move_to_end(key)
+        while len(self.days) > self.size:
+            self.days.popitem(last=False)
+
+    def drop(self, key):
+        if self.days.pop(key, None) is not None:
+            logging.debug("%s changed in the archive, reloading", key)
+
+
+class PriceArchive:
+
+    # The long-term price log, one SQLite file instead of a JSON file per day
+    # and area in log/. Prices are indexed on (area, start_time) and (area,
+    # day), so a range of days is one query. A day is always written in one
+    # transaction. changed(area, day) is called after a day is written.
+
+    def __init__(self, path, changed=None):
+        self.path = path
+        self.changed = changed
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS prices (
+                    area TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    start_time INTEGER NOT NULL,
+                    end_time INTEGER NOT NULL,
+                    utc_offset INTEGER NOT NULL,
+                    sek REAL NOT NULL,
+                    eur REAL,
+                    exr REAL,
+                    PRIMARY KEY (area, start_time)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS prices_day ON prices (area, day);
+                CREATE TABLE IF NOT EXISTS imported (filename TEXT PRIMARY KEY);
+                """
+            )
 
-        # List for devices to control
-        self.deviceframe = ttk.Labelframe(self, text="Devices to control")
-        self.devicelist = Listbox(self.deviceframe, height=8, width=45)
-        self.delete_btn = ttk.Button(
-            self.deviceframe, text="Remove selected", command=self.remove_device
-        )
+    def put_day(self, area, day, entries):
 
-        self.deviceframe.grid(column=0, row=1, padx=5, pady=1, rowspan=8, sticky="nw")
-        self.devicelist.grid(column=0, row=0, padx=4, pady=4, ipadx=1)
-        self.delete_btn.grid(column=0, row=1, sticky="nw", padx=8, pady=8)
-
-        # Custom On commands
-        self.customonframe = ttk.Labelframe(self, text="Custom On command")
-        self.customonentry = ttk.Entry(self.customonframe)
-        self.customonframe.grid(column=4, row=4, padx=5, pady=9, sticky="nw")
-        self.customonentry.grid(column=0, row=0, padx=5, pady=5, ipadx=46, columnspan=1)
-        self.customonentry.insert(0, self.oncommand)
-
-        # Custom Off commands
-        self.customoffframe = ttk.Labelframe(self, text="Custom Off command")
-        self.customoffentry = ttk.Entry(self.customoffframe)
-        self.customoffframe.grid(column=4, row=5, padx=5, pady=0, sticky="nw")
-        self.customoffentry.grid(
-            column=0, row=0, padx=5, pady=5, ipadx=46, columnspan=1
-        )
-        self.customoffentry.insert(0, self.offcommand)
-
-        # Graph
-        self.graphheight = 230
-        self.graphwidth = 600
-        self.graphframe = ttk.Labelframe(self, text="Price graph")
-        self.graph = Canvas(
-            self.graphframe, height=self.graphheight, width=self.graphwidth, bg="white"
-        )
+        # An empty day is never stored, it would hide the missing prices
+        if not entries:
+            return
+        rows = []
+        for hour in entries:
+            time_start = datetime.fromisoformat(hour["time_start"])
+            time_end = datetime.fromisoformat(hour["time_end"])
+            rows.append(
+                (
+                    area,
+                    day,
+                    int(time_start.timestamp()),
+                    int(time_end.timestamp()),
+                    int(time_start.utcoffset().total_seconds() // 60),
+                    hour["SEK_per_kWh"],
+                    hour.get("EUR_per_kWh"),
+                    hour.get("EXR"),
+                )
+            )
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM prices WHERE area = ? AND day = ?", (area, day)
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO prices VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+        if self.changed is not None:
+            self.changed(area, day)
+
+    def get_day(self, area, day):
+
+        # Returns the day in the same format as the price API, or None
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT start_time, end_time, utc_offset, sek, eur, exr "
+                "FROM prices WHERE area = ? AND day = ? ORDER BY start_time",
+                (area, day),
+            ).fetchall()
+        if not rows:
+            return None
+
+        entries = []
+        for start_time, end_time, utc_offset, sek, eur, exr in rows:
+            offset = timezone(timedelta(minutes=utc_offset))
+            time_start = datetime.fromtimestamp(start_time, offset)
+            time_end = datetime.fromtimestamp(end_time, offset)
+            entries.append(
+                {
+                    "SEK_per_kWh": sek,
+                    "EUR_per_kWh": eur,
+                    "EXR": exr,
+                    "time_start": time_start.isoformat(),
+                    "time_end": time_end.isoformat(),
+                }
+            )
+        return entries
+
+    def prices(self, area, first_day, last_day):
+
+        # All prices of an area between two days, both included, as
+        # (day, start_time, end_time, sek) rows in time order
+        with self.lock:
+            return self.connection.execute(
+                "SELECT day, start_time, end_time, sek FROM prices "
+                "WHERE area = ? AND day BETWEEN ? AND ? ORDER BY start_time",
+                (area, first_day, last_day),
+            ).fetchall()
+
+    def days(self, area):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT DISTINCT day FROM prices WHERE area = ?", (area,)
+            ).fetchall()
+        return set(row[0] for row in rows)
+
+    def import_file(self, path):
+
+        # log files are named like 2025-01-15_SE3.json
+        filename = os.path.basename(path)
+        day, area = filename[: -len(".json")].split("_")
+        with open(path, "r") as fp:
+            self.put_day(area, day, json.load(fp))
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO imported VALUES (?)", (filename,)
+            )
 
-        self.graphframe.grid(
-            column=3, row=0, padx=5, pady=5, rowspan=4, sticky="nw", columnspan=2
-        )
-        self.graph.grid(column=0, row=0, padx=4, pady=4)
+    def import_log(self, folder):
 
-        self.populate_list()
+        # Imports the day files from older versions, once
+        if not os.path.isdir(folder):
+            return 0
+        with self.lock:
+            done = set(
+                row[0]
+                for row in self.connection.execute("SELECT filename FROM imported")
+            )
+        count = 0
+        for filename in sorted(os.listdir(folder)):
+            if not filename.endswith(".json") or filename in done:
+                continue
+            try:
+                self.import_file(os.path.join(folder, filename))
+                count += 1
+            except Exception as e:
+                logging.error("Could not import %s: %s", filename, e)
+        if count:
+            logging.info("Imported %s price files from %s", count, folder)
+        return count
 
-    def populate_list(self):
-        if os.path.exists("devices"):
-            with open("devices", "r", encoding="utf-8") as file:
-                file = file.readlines()
-                for line in file:
-                    logging.info("Loading saved device: %s", line[:-1])
-                    device_id = line.split(" ")[0]
-                    self.controldevicelist[str(device_id)] = line[:-1]
-        for device in self.controldevicelist.values():
-            self.devicelist.insert(0, device)
-        return
 
-    def save_devices(self):
-        list_to_save = ""
-        device_file = "devices"
-        for device in self.controldevicelist.values():
-            list_to_save += device + "\n"
-        if os.path.exists(device_file):
-            os.remove(device_file)
-        with open(device_file, "w", encoding="utf-8") as file:
-            file.write(list_to_save)
-            logging.info("Saving devices to file:")
-            logging.info(list_to_save)
-        return
+class FetchBackoff:
 
-    def add_device(self):
-        device_string = self.device_combo.get()
-        device_id = device_string.split(" ")[0]
-        logging.info("%s added", device_id)
+    # Remembers failed price fetches so a tick does not repeat a request that
+    # just failed. The wait doubles after every failure up to max_delay.
 
-        if device_string == "Select one":
-            return
+    def __init__(self, base_delay=60, max_delay=1800):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = {}
 
-        self.controldevicelist[device_id] = device_string
+    def ready(self, key):
+        if key not in self.failures:
+            return True
+        return time.monotonic() >= self.failures[key][1]
 
-        self.devicelist.delete(0, 666)
-        for device in self.controldevicelist.values():
-            self.devicelist.insert(0, device)
+    def failed(self, key):
+        count = self.failures.get(key, (0, 0))[0] + 1
+        delay = min(self.base_delay * 2 ** (count - 1), self.max_delay)
+        self.failures[key] = (count, time.monotonic() + delay)
+        logging.info("Fetching %s failed %s times, next try in %s s", key, count, delay)
 
-        self.save_devices()
+    def succeeded(self, key):
+        self.failures.pop(key, None)
 
-    def remove_device(self):
-        selected = self.devicelist.curselection()
-        device_string = self.devicelist.get(selected)
-        device_id = device_string.split(" ")[0]
-        logging.info("%s removed", device_id)
+    def wait(self, key):
+        if key not in self.failures:
+            return 0
+        return max(self.failures[key][1] - time.monotonic(), 0)
 
-        self.controldevicelist.pop(device_id, None)
 
-        self.devicelist.delete(0, 666)
-        for device in self.controldevicelist.values():
-            self.devicelist.insert(0, device)
+class RateLimiter:
 
-        self.save_devices()
+    # Spaces out requests from many threads to at most rate per second
 
-    def fixedprice(self):
-        if self.controltype.get() == "fixed":
-            self.triggerprice = float(self.pricefixed_val.get())
-            self.update_list_today()
-            if self.tomorrows_price.__class__ == list:
-                self.update_list_tomorrow()
-            logging.debug("fixed: %s", self.triggerprice)
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
 
-        return
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        time.sleep(start - now)
 
-    def ratioprice(self):
-        if self.controltype.get() == "ratio":
 
-            # todays prices
-            prices = []
-            for hour in self.todays_price:
-                prices.append(float(hour["SEK_per_kWh"]))
+class ReplayClock:
 
+    # A clock for replays, epoch seconds that only move when advanced
 
-            # here we convert the set value for ratio into a number of entries
-            # since number of entries may or may not correspond to hours
-            set_ratio = self.priceratio_val.get()
-            number_of_entries = (int(set_ratio) / 24) * len(prices)
+    def __init__(self, start):
+        self.now = start
 
-            # a clever way to find the trigger point from the ratio
-            # sort the list of prices and use the entry ratio number as index
-            prices.sort()
-            self.triggerprice = float(prices[int(number_of_entries)])
+    def __call__(self):
+        return self.now
 
-            # tomorrows prices
-            if self.tomorrows_price.__class__ == list:
-                prices = []
-                for hour in self.tomorrows_price:
-                    prices.append(float(hour["SEK_per_kWh"]))
+    def advance(self, seconds):
+        self.now += seconds
 
-                # here we convert the set value for ratio into a number of entries
-                # since number of entries may or may not correspond to hours
-                set_ratio = self.priceratio_val.get()
-                number_of_entries = (int(set_ratio) / 24) * len(prices)
 
-                # a clever way to find the trigger point from the ratio
-                # sort the list of prices and use the entry ratio number as index
-                prices.sort()
-                self.triggerprice_tomorrow = float(prices[int(number_of_entries)])
+class CommandRunner:
 
+    # Runs the custom ON/OFF commands. Every process is waited on by a thread
+    # of its own, so no zombies are left behind, and killed after timeout
+    # seconds. At most limit copies of a hook run at the same time, a
+    # trigger while they are still running is dropped.
 
-        self.update_list_today()
-        if self.tomorrows_price.__class__ == list:
-            self.update_list_tomorrow()
-        return
+    def __init__(self, timeout=60, limit=1):
+        self.timeout = timeout
+        self.limit = limit
+        self.running = {}
+        self.lock = threading.Lock()
 
-    def refresh_devices(self):
+    def run(self, hook, command):
+        with self.lock:
+            if self.running.get(hook, 0) >= self.limit:
+                logging.info("%s command is still running, not started again", hook)
+                metrics.inc(
+                    "price_control_custom_commands_total", hook=hook, result="dropped"
+                )
+                return False
+            self.running[hook] = self.running.get(hook, 0) + 1
 
-        dict_data = {}
-        command_request = "http://" + self.api_entry.get() + "/api/devices/list"
-        headers = {"Authorization": self.auth_entry.get()}
+        logging.info("Executing: %s", command)
+        started = time.monotonic()
         try:
-            json_data = requests.request(
-                "GET", command_request, headers=headers, data="", timeout=self.timeout
-            )
-
-            dict_data = json_data.json()
-            logging.info(json.dumps(dict_data, indent=2, sort_keys=True))
-
+            process = subprocess.Popen(command)
         except Exception as e:
-            logging.error(e)
-
-        if "device" not in dict_data:
-            logging.error("No devices in response.")
-            self.devicelist_text["text"] = "No response."
-            self.device_combo.set("No devices")
-            self.device_combo["values"] = ""
-            return
-
-        if len(dict_data["device"]) > 0:
-            self.devicelist_text["text"] = (
-                str(len(dict_data["device"])) + " devices found"
+            logging.error("Could not run %s: %s", command, e)
+            self.finished(hook, command, None, started, "error")
+            return False
+
+        threading.Thread(
+            target=self.wait,
+            args=(hook, command, process, started),
+            name="custom-" + hook,
+            daemon=True,
+        ).start()
+        return True
+
+    def wait(self, hook, command, process, started):
+        try:
+            returncode = process.wait(timeout=self.timeout)
+            result = "ok" if returncode == 0 else "error"
+        except subprocess.TimeoutExpired:
+            logging.warning(
+                "%s took longer than %s s, stopping it", command, self.timeout
             )
-            device_list = []
-
-            for device in dict_data["device"]:
-
-                device_list.append(str(device["id"]) + " - " + device["name"])
-
-            self.device_combo.set("Select one")
-            self.device_combo["values"] = device_list
-        return
-
-    def onbutton(self):
-        device_string = self.device_combo.get()
-        device_id = device_string.split(" ")[0]
-        logging.info("%s on", device_id)
-
-        command_request = "http://" + self.api_entry.get() + "/api/device/turnOn"
+            process.kill()
+            returncode = process.wait()
+            result = "timeout"
+        self.finished(hook, command, returncode, started, result)
+
+    def finished(self, hook, command, returncode, started, result):
+        seconds = time.monotonic() - started
+        with self.lock:
+            self.running[hook] -= 1
+        if returncode is not None:
+            logging.info("%s exited with %s after %.1f s", command, returncode, seconds)
+        metrics.observe("price_control_custom_command_seconds", seconds, hook=hook)
+        metrics.inc("price_control_custom_commands_total", hook=hook, result=result)
+
+
+class CircuitBreaker:
+
+    # Stops sending to a TellStick that does not answer. After threshold
+    # failures in a row it opens and commands fail at once instead of waiting
+    # for REQUEST_TIMEOUT. After cooldown seconds one request is let through
+    # as a probe, a failed probe doubles the cooldown up to max_cooldown.
+
+    def __init__(self, name, threshold=3, cooldown=10, max_cooldown=300):
+        self.name = name
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.open_until = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.open_until is None:
+                return True
+            if self.probing or time.monotonic() < self.open_until:
+                return False
+            self.probing = True
+            return True
+
+    def closed(self):
+        with self.lock:
+            return self.open_until is None
+
+    def succeeded(self):
+
+        # True if the breaker was open, so queued commands can go now
+        with self.lock:
+            was_open = self.open_until is not None
+            self.failures = 0
+            self.open_until = None
+            self.probing = False
+            self.cooldown = self.base_cooldown
+        if was_open:
+            logging.warning("TellStick %s is answering again", self.name)
+        metrics.set("price_control_tellstick_up", 1, tellstick=self.name)
+        return was_open
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing:
+                self.probing = False
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            elif self.open_until is not None or self.failures < self.threshold:
+                return
+            else:
+                logging.warning(
+                    "TellStick %s is not answering, pausing commands", self.name
+                )
+            self.open_until = time.monotonic() + self.cooldown
+        metrics.set("price_control_tellstick_up", 0, tellstick=self.name)
+
+
+class DeviceDispatcher:
+
+    # Sends device commands to the TellSticks concurrently. Every TellStick
+    # has a small pool of worker threads sharing one keep-alive session of
+    # its own, so one slow plug only delays its own command and one slow
+    # TellStick does not hold up the others. Switching 30 plugs takes about
+    # as long as switching one.
+    #
+    # Failed commands are retried from a background thread with a growing
+    # delay. Only the latest command for each device is kept, a newer one
+    # replaces it. A circuit breaker per TellStick fails commands at once
+    # while it is down, and everything queued for it is sent as soon as it
+    # answers again.
+
+    def __init__(self, workers, retry_delay=5, max_retry_delay=300):
+
+        # workers is the number of commands sent to a TellStick at once,
+        # limits can set another number for some of them
+        self.workers = workers
+        self.limits = {}
+        self.sessions = {}
+        self.pools = {}
+        self.session_lock = threading.Lock()
+
+        self.breakers = {}
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.retries = {}
+        self.attempts = {}
+        self.desired = {}
+        self.retry_lock = threading.Condition()
+        self.retry_thread = None
+
+    def get_session(self, tell_api):
+
+        # requests is slow to import, so it waits until the first command
+        with self.session_lock:
+            if tell_api not in self.sessions:
+                import requests
+
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.limits.get(tell_api, self.workers),
+                )
+                session.mount("http://", adapter)
+                self.sessions[tell_api] = session
+            return self.sessions[tell_api]
+
+    def get_pool(self, tell_api):
+        with self.session_lock:
+            if tell_api not in self.pools:
+                self.pools[tell_api] = ThreadPoolExecutor(
+                    max_workers=self.limits.get(tell_api, self.workers),
+                    thread_name_prefix="dispatch",
+                )
+            return self.pools[tell_api]
+
+    def shutdown(self):
+        with self.session_lock:
+            for pool in self.pools.values():
+                pool.shutdown()
+            self.pools = {}
+
+    def breaker(self, tell_api):
+        with self.retry_lock:
+            if tell_api not in self.breakers:
+                self.breakers[tell_api] = CircuitBreaker(tell_api)
+            return self.breakers[tell_api]
+
+    def send(self, tell_api, auth, timeout, device_id, method):
+
+        # Returns a result for one device, never raises. "retry" is only set
+        # for errors a retry can fix: no answer or a 5xx reply. A TellStick
+        # that refuses the command, for an unknown device or a method it does
+        # not support, would refuse it again.
+        command_request = "http://" + tell_api + "/api/device/" + method
         payload = "id=" + device_id
-        headers = {"Authorization": self.auth_entry.get()}
+        headers = {"Authorization": auth}
+        result = {"id": device_id, "method": method, "ok": False, "reply": None}
+
+        breaker = self.breaker(tell_api)
+        if not breaker.allow():
+            result["reply"] = "TellStick " + tell_api + " is not answering"
+            result["skipped"] = True
+            result["retry"] = True
+            result["seconds"] = 0.0
+            metrics.inc(
+                "price_control_commands_total",
+                tellstick=tell_api,
+                device=device_id,
+                result="skipped",
+            )
+            return result
+
+        started = time.monotonic()
+        answered = False
         try:
-            json_data = requests.request(
-                "GET",
+            json_data = self.get_session(tell_api).get(
                 command_request,
                 headers=headers,
                 params=payload,
-                timeout=self.timeout,
+                timeout=timeout,
             )
+            answered = json_data.status_code < 500
             dict_data = json_data.json()
-            logging.info(dict_data)
+            result["reply"] = dict_data
+            result["ok"] = json_data.ok and "error" not in dict_data
 
         except Exception as e:
-            logging.error(e)
-
-        return
-
-    def offbutton(self):
-        device_string = self.device_combo.get()
-        device_id = device_string.split(" ")[0]
-        logging.info("%s off", device_id)
-
-        command_request = "http://" + self.api_entry.get() + "/api/device/turnOff"
-        payload = "id=" + device_id
-        headers = {"Authorization": self.auth_entry.get()}
+            result["reply"] = str(e)
+        result["retry"] = not answered
+
+        if not answered:
+            breaker.failed()
+        elif breaker.succeeded():
+            self.retry_now(tell_api)
+
+        result["seconds"] = time.monotonic() - started
+        metrics.observe(
+            "price_control_command_seconds",
+            result["seconds"],
+            tellstick=tell_api,
+            device=device_id,
+        )
+        metrics.inc(
+            "price_control_commands_total",
+            tellstick=tell_api,
+            device=device_id,
+            result="ok" if result["ok"] else "error",
+        )
+        return result
+
+    def list_devices(self, tell_api, auth, timeout):
+
+        # Every device from one /api/devices/list call, as dicts with id,
+        # name, methods and state "ON", "OFF" or None if the TellStick can not
+        # know it. Dimmed devices count as on. None if it did not answer.
+        command_request = "http://" + tell_api + "/api/devices/list"
+        headers = {"Authorization": auth}
+        breaker = self.breaker(tell_api)
+        if not breaker.allow():
+            return None
         try:
-            json_data = requests.request(
-                "GET",
+            json_data = self.get_session(tell_api).get(
                 command_request,
                 headers=headers,
-                params=payload,
-                timeout=self.timeout,
+                params="supportedMethods=19",
+                timeout=timeout,
             )
-            dict_data = json_data.json()
-            logging.info(dict_data)
-
+            devices = json_data.json()["device"]
         except Exception as e:
-            logging.error(e)
-
-        return
+            logging.error("Listing devices failed: %s", e)
+            breaker.failed()
+            return None
+        if breaker.succeeded():
+            self.retry_now(tell_api)
+        logging.debug("%s devices listed", len(devices))
+
+        listed = []
+        for device in devices:
+            if "id" not in device:
+                logging.warning("Device without id from %s: %s", tell_api, device)
+                continue
+            state = None
+            if device.get("state") in (1, 16):
+                state = "ON"
+            elif device.get("state") == 2:
+                state = "OFF"
+            listed.append(
+                {
+                    "id": str(device["id"]),
+                    "name": device.get("name", ""),
+                    "methods": device.get("methods", 0),
+                    "state": state,
+                }
+            )
+        return listed
+
+    def dispatch(self, tell_api, auth, timeout, commands):
+
+        # commands is a list of (device_id, method)
+        return self.dispatch_many([(tell_api, auth, timeout, commands)])[0]
+
+    def dispatch_many(self, batches):
+
+        # batches is a list of (tell_api, auth, timeout, commands). Every
+        # TellStick is sent to at the same time, a list of results is
+        # returned for each batch.
+        started = time.monotonic()
+        submitted = []
+        for tell_api, auth, timeout, commands in batches:
+            with self.retry_lock:
+                for device_id, method in commands:
+                    self.retries.pop((tell_api, device_id), None)
+                    self.desired[(tell_api, device_id)] = method
+            pool = self.get_pool(tell_api)
+            submitted.append(
+                [
+                    pool.submit(self.send, tell_api, auth, timeout, device_id, method)
+                    for device_id, method in commands
+                ]
+            )
 
-    def timer_loop(self):
+        everything = []
+        for (tell_api, auth, timeout, commands), futures in zip(batches, submitted):
+            results = [future.result() for future in futures]
+            elapsed = time.monotonic() - started
+            self.report(tell_api, results, elapsed)
+            self.queue_failed(tell_api, auth, timeout, results)
+            everything.append(results)
+        return everything
+
+    def report(self, tell_api, results, elapsed):
+        failed = [result for result in results if not result["ok"]]
+        skipped = [result for result in failed if result.get("skipped")]
+        for result in results:
+            logging.debug(
+                "%s %s: %s (%.3f s)",
+                result["id"],
+                result["method"],
+                result["reply"],
+                result["seconds"],
+            )
+        for result in failed:
+            if result.get("skipped"):
+                continue
+            if result["retry"]:
+                logging.error(
+                    "%s %s failed: %s", result["id"], result["method"], result["reply"]
+                )
+            else:
+                logging.error(
+                    "%s %s refused by %s, not retried: %s",
+                    result["id"],
+                    result["method"],
+                    tell_api,
+                    result["reply"],
+                )
+        if skipped:
+            logging.warning(
+                "TellStick %s is not answering, %s commands queued",
+                tell_api,
+                len(skipped),
+            )
+        logging.info(
+            "%s commands sent to %s in %.3f s, %s failed",
+            len(results),
+            tell_api,
+            elapsed,
+            len(failed),
+        )
 
-        time_now = datetime.now()
-        date_to_fetch = datetime.strftime(time_now, "%Y/%m-%d")
-        setattr(self, "date_to_fetch", date_to_fetch)
-        todays_price = self.getprice()
-        if todays_price:
-            setattr(self, "todays_price", todays_price)
-        else:
-            setattr(self, "todays_price", self.defaultprice())
+    def queue_failed(self, tell_api, auth, timeout, results):
+
+        # Failed commands wait for a retry unless a newer command for the
+        # device came in meanwhile or the TellStick refused them. Commands
+        # skipped while a probe brought the TellStick back go again at once.
+        closed = self.breaker(tell_api).closed()
+        with self.retry_lock:
+            for result in results:
+                key = (tell_api, result["id"])
+                if self.desired.get(key) != result["method"]:
+                    continue
+                if result["ok"] or not result["retry"]:
+                    self.attempts.pop(key, None)
+                    continue
+                attempts = self.attempts.get(key, 0) + 1
+                self.attempts[key] = attempts
+                delay = min(
+                    self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay
+                )
+                if closed and result.get("skipped"):
+                    delay = 0
+                self.retries[key] = [
+                    result["method"],
+                    auth,
+                    timeout,
+                    time.monotonic() + delay,
+                ]
+            metrics.set("price_control_retry_queue", len(self.retries))
+            if not self.retries:
+                return
+            if self.retry_thread is None:
+                self.retry_thread = threading.Thread(
+                    target=self.retry_loop, name="retry", daemon=True
+                )
+                self.retry_thread.start()
+            self.retry_lock.notify()
+
+    def retry_now(self, tell_api):
+        with self.retry_lock:
+            for key, entry in self.retries.items():
+                if key[0] == tell_api:
+                    entry[3] = 0
+            self.retry_lock.notify()
+
+    def retry_loop(self):
+        while True:
+            with self.retry_lock:
+                while True:
+                    now = time.monotonic()
+                    times = dict((key, entry[3]) for key, entry in self.retries.items())
+                    due = [key for key, when in times.items() if when <= now]
+                    if due:
+                        break
+                    wait = min(times.values(), default=None)
+                    self.retry_lock.wait(None if wait is None else wait - now)
+
+                batches = {}
+                for key in due:
+                    method, auth, timeout, _ = self.retries.pop(key)
+                    batch = batches.setdefault((key[0], auth, timeout), [])
+                    batch.append((key[1], method))
+
+            for (tell_api, auth, timeout), commands in batches.items():
+                logging.info("Retrying %s commands to %s", len(commands), tell_api)
+                self.dispatch(tell_api, auth, timeout, commands)
+
+
+def load_gateways(config):
+
+    # More TellSticks, each in a section of its own in settings.ini:
+    #   [GATEWAY barn]
+    #   TELL_API = 192.168.1.51
+    # AUTH and WORKERS default to AUTH and COMMAND_WORKERS in APP.
+    gateways = {}
+    for section in config.sections():
+        if not section.startswith("GATEWAY "):
+            continue
+        name = section[len("GATEWAY ") :].strip()
+        gateways[name] = {
+            "tell_api": config.get(section, "TELL_API"),
+            "auth": config.get(section, "AUTH", fallback=config.get("APP", "AUTH")),
+            "workers": config.getint(
+                section,
+                "WORKERS",
+                fallback=config.getint("APP", "COMMAND_WORKERS", fallback=8),
+            ),
+        }
+    return gateways
+
+
+def device_key(gateway, device_id):
+
+    # Device ids are only unique on one TellStick, so devices on the other
+    # gateways are known as "gateway/id". The one in APP has no prefix.
+    if not gateway:
+        return str(device_id)
+    return gateway + "/" + str(device_id)
+
+
+def split_key(key):
+    gateway, _, device_id = key.rpartition("/")
+    return gateway, device_id
+
+
+class DeviceRegistry:
+
+    # The devices of the TellSticks by id, with gateway, name, methods and
+    # last known state. The list is fetched again when it is older than ttl
+    # seconds, in a thread of its own, and the old one is answered meanwhile.
+    # fetch returns {gateway: devices, or None if it did not answer}.
+    # changed() is called after a new list is stored.
+
+    def __init__(self, fetch, ttl=300, changed=None):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.changed = changed
+        self.devices = {}
+        self.updated = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def refresh(self):
+
+        # Fetches the list now. Returns the devices, or None if no TellStick
+        # answered. The devices of one that did not answer are kept, with
+        # their state unknown.
+        try:
+            listed = self.fetch()
+        finally:
+            # a failed fetch must not keep get() from starting the next one
+            with self.lock:
+                self.refreshing = False
+        with self.lock:
+            if all(devices is None for devices in listed.values()):
+                return None
+            devices = {}
+            for gateway, gateway_devices in listed.items():
+                if gateway_devices is None:
+                    for device in self.devices.values():
+                        if device["gateway"] == gateway:
+                            devices[device["id"]] = dict(device, state=None)
+                else:
+                    devices.update((device["id"], device) for device in gateway_devices)
+            self.devices = devices
+            self.updated = time.monotonic()
+            metrics.set("price_control_registry_devices", len(self.devices))
+            devices = list(self.devices.values())
+        # outside the lock, changed() reads the states back
+        if self.changed is not None:
+            self.changed()
+        return devices
+
+    def get(self):
+
+        # Only waits for the TellStick the first time
+        with self.lock:
+            if self.updated is not None:
+                stale = time.monotonic() - self.updated >= self.ttl
+                if stale and not self.refreshing:
+                    self.refreshing = True
+                    threading.Thread(
+                        target=self.background_refresh, name="registry", daemon=True
+                    ).start()
+                return list(self.devices.values())
+        return self.refresh()
+
+    def background_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            logging.exception("Refreshing the device list failed")
 
-        tomorrow = time_now + timedelta(1)
-        date_to_fetch = datetime.strftime(tomorrow, "%Y/%m-%d")
-        setattr(self, "date_to_fetch", date_to_fetch)
-        setattr(self, "tomorrows_price", self.getprice())
+    def lookup(self, device_id):
+        with self.lock:
+            return self.devices.get(device_id)
 
-        # self.update_list()
-        self.ratioprice()  # Run this to update ratio in case of date change
+    def state(self, device_id):
+        device = self.lookup(device_id)
+        return device["state"] if device else None
 
-        if self.pricenow < self.triggerprice:
-            if self.lastaction == "ON" and self.checkoverride_val.get() != "ON":
-                self.lastaction_label["text"] = "Last action: ON"
-                logging.debug("Already ON")
+    def record(self, results):
 
-            else:
-                self.lastaction_label["text"] = "Last action: Switching ON"
-                logging.info("Switching ON")
-                self.devices_on()
-            self.lastaction = "ON"
-        else:
-            if self.lastaction == "OFF" and self.checkoverride_val.get() != "ON":
-                self.lastaction_label["text"] = "Last action: OFF"
-                logging.debug("Already OFF")
-            else:
-                self.lastaction_label["text"] = "Last action: Switching OFF"
-                logging.info("Switching OFF")
-                self.devices_off()
-            self.lastaction = "OFF"
+        # Successful commands set the state, so it is right until the next
+        # fetch without asking the TellStick
+        with self.lock:
+            for result in results:
+                device = self.devices.get(result["device"])
+                if result["ok"] and device is not None:
+                    device["state"] = "ON" if result["method"] == "turnOn" else "OFF"
 
-        self.lastupdate["text"] = datetime.strftime(
-            datetime.now(), "Last update: %H:%M:%S"
-        )
-        logging.debug("Waiting for %s milliseconds.", self.delayseconds)
-        self.after(self.delayseconds, self.timer_loop)
 
-    def devices_on(self):
+class PriceEngine:
 
-        if self.customonentry.get():
-            logging.info("Executing: %s", self.customonentry.get())
-            try:
-                subprocess.Popen(self.customonentry.get())
-            except Exception:
-                pass
+    # The control logic of Price Control. It fetches prices, finds the trigger
+    # price and switches the devices. It does not know about Tk, the window in
+    # price_control_gui.py is only a view on top of it.
 
-        for device_id in self.controldevicelist.keys():
+    def __init__(self):
 
-            logging.info("%s on", device_id)
+        logging.debug("Building price engine")
+        self.area = str(config["APP"]["AREA"])
+        self.el_api = str(config["APP"]["EL_API"])
+        self.request_timeout = int(config["APP"]["REQUEST_TIMEOUT"])
+        self.delayseconds = int(config["APP"]["UPDATE_INTERVAL"]) * 1000
+        self.tell_api = str(config["APP"]["TELL_API"])
+        self.auth = str(config["APP"]["AUTH"])
+        self.timeout = int(config["APP"]["REQUEST_TIMEOUT"])
+        self.gateways = load_gateways(config)
+        self.mode = str(config["APP"]["MODE"])
+        self.override = str(config["APP"]["OVERRIDE"])
+        self.resync_interval = config.getint("APP", "RESYNC_INTERVAL", fallback=3600)
+        self.next_resync = 0
+        self.oncommand = str(config["APP"]["ON_COMMAND"])
+        self.offcommand = str(config["APP"]["OFF_COMMAND"])
+        self.fixed = float(config["APP"]["PRICE"])
+        self.ratio = int(config["APP"]["RATIO"])
+        self.min_on = config.getint("APP", "MIN_ON", fallback=0)
+        self.max_switches = config.getint("APP", "MAX_SWITCHES", fallback=0)
+        self.workers = config.getint("APP", "COMMAND_WORKERS", fallback=8)
+        self.archive_path = config.get("APP", "ARCHIVE", fallback="prices.db")
+        self.publish_hour = config.getint("APP", "PUBLISH_HOUR", fallback=13)
+        self.preroll = config.getint("APP", "PREROLL", fallback=0)
+        self.metrics_address = config.get(
+            "APP", "METRICS_ADDRESS", fallback="127.0.0.1"
+        )
+        self.metrics_port = config.getint("APP", "METRICS_PORT", fallback=0)
+        self.metrics_file = config.get("APP", "METRICS_FILE", fallback="")
+        self.api_address = config.get("APP", "API_ADDRESS", fallback="127.0.0.1")
+        self.api_port = config.getint("APP", "API_PORT", fallback=0)
+        self.api_token = config.get("APP", "API_TOKEN", fallback="")
+        self.max_sleep = 900
+
+        # the time as epoch seconds, a replay swaps in its own clock
+        self.clock = time.time
+        self.fetch_prices = True
+
+        # the API answers, {path: (etag, body)}, and the settings it changed
+        # that the next tick applies. woken cuts the wait for the next tick.
+        self.responses = {}
+        self.publish_lock = threading.Lock()
+        self.pending_settings = {}
+        self.settings_lock = threading.Lock()
+        self.settings_version = 0
+        self.woken = threading.Event()
 
-            command_request = "http://" + self.api_entry.get() + "/api/device/turnOn"
-            payload = "id=" + device_id
-            headers = {"Authorization": self.auth_entry.get()}
-            try:
-                json_data = requests.request(
-                    "GET",
-                    command_request,
-                    headers=headers,
-                    params=payload,
-                    timeout=self.timeout,
-                )
-                dict_data = json_data.json()
-                logging.info(dict_data)
+        self.triggerprice = 0
+        self.triggerprice_tomorrow = 0
+        self.plan_today = array("b")
+        self.plan_tomorrow = None
+        self.device_policies = {}
+        self.default_devices = []
+        self.policy_devices = {}
+        self.policy_plans = {}
+        self.lastactions = {}
+        self.lastaction = ""
+        self.controldevicelist = {}
+        self.pricenow = 0
+        self.avgprice = 0
+        self.highestprice = 0
+        self.lowestprice = 0
+        self.date_to_fetch = ""
 
-            except Exception as e:
-                logging.error(e)
-        return
+        self.tomorrows_price = None
+        self.todays_price = PriceSeries([])
+        self.using_defaultprice = False
+        self.loading = True
+        self.area_prices = {}
+        self.default_series = None
+
+        self.dispatcher = DeviceDispatcher(self.workers)
+        for gateway in self.gateways.values():
+            self.dispatcher.limits[gateway["tell_api"]] = gateway["workers"]
+        self.registry = DeviceRegistry(
+            self.fetch_devices,
+            config.getint("APP", "DEVICE_TTL", fallback=300),
+            self.publish,
+        )
+        self.custom = CommandRunner(
+            config.getint("APP", "CUSTOM_TIMEOUT", fallback=60),
+            config.getint("APP", "CUSTOM_LIMIT", fallback=1),
+        )
+        self.price_cache = PriceCache(size=16)
+        self.archive = PriceArchive(self.archive_path, self.day_changed)
+        self.archive.import_log("log")
+        self.fetch_backoff = FetchBackoff()
+        self.planner = Planner(size=64)
+
+        self.load_devices()
+        self.load_policies()
+
+    def load_devices(self):
+
+        # devices.ini has a section per device id. The plain "devices" list of
+        # older versions, one "id - name" per line, is read once and saved
+        # as devices.ini.
+        if os.path.exists("devices.ini"):
+            devices = configparser.ConfigParser()
+            devices.read("devices.ini", encoding="utf-8")
+            for device_id in devices.sections():
+                self.controldevicelist[device_id] = {
+                    "id": device_id,
+                    "name": devices[device_id].get("NAME", ""),
+                    "methods": devices[device_id].getint("METHODS", 0),
+                }
+        elif os.path.exists("devices"):
+            with open("devices", "r", encoding="utf-8") as file:
+                for line in file:
+                    device_id, _, name = line.strip().partition(" - ")
+                    if device_id:
+                        self.controldevicelist[device_id] = {
+                            "id": device_id,
+                            "name": name,
+                            "methods": 0,
+                        }
+            logging.info("Moving the devices file to devices.ini")
+            self.save_devices()
+        for device in self.controldevicelist.values():
+            logging.info("Loading saved device: %s - %s", device["id"], device["name"])
 
-    def devices_off(self):
+    def save_devices(self):
+        devices = configparser.ConfigParser()
+        for device_id, device in self.controldevicelist.items():
+            devices[device_id] = {
+                "NAME": device["name"],
+                "METHODS": str(device["methods"]),
+            }
+        with open("devices.ini", "w", encoding="utf-8") as file:
+            devices.write(file)
+        logging.info("Saving %s devices to devices.ini", len(self.controldevicelist))
+
+    def load_policies(self):
+
+        # Devices can have a policy of their own in policies.ini, with the
+        # device id as section name. Other devices follow the main settings.
+        self.device_policies = {}
+        if os.path.exists("policies.ini"):
+            policies = configparser.ConfigParser()
+            policies.read("policies.ini")
+            for device_id in policies.sections():
+                section = policies[device_id]
+                area = section.get("AREA", self.area)
+                self.device_policies[device_id] = Policy(
+                    section.get("MODE", "fixed"),
+                    section.getfloat("PRICE", self.fixed),
+                    section.getint("RATIO", self.ratio),
+                    section.getint("MIN_ON", 0),
+                    section.getint("MAX_SWITCHES", 0),
+                    None if area == self.area else area,
+                )
+                logging.info(
+                    "Loading policy for device %s: %s",
+                    device_id,
+                    self.device_policies[device_id].key(),
+                )
+        self.update_groups()
 
-        if self.customoffentry.get():
-            logging.info("Executing: %s", self.customoffentry.get())
-            try:
-                subprocess.Popen(self.customoffentry.get())
-            except Exception:
-                pass
+    def update_groups(self):
 
+        # Devices sharing a policy are planned and switched as one group, so
+        # the work per tick depends on the number of policies, not devices
+        default_devices = []
+        policy_devices = {}
         for device_id in self.controldevicelist.keys():
+            policy = self.device_policies.get(device_id)
+            if policy is None:
+                default_devices.append(device_id)
+            else:
+                policy_devices.setdefault(policy.key(), []).append(device_id)
+        self.default_devices = default_devices
+        self.policy_devices = policy_devices
 
-            logging.info("%s off", device_id)
-
-            command_request = "http://" + self.api_entry.get() + "/api/device/turnOff"
-            payload = "id=" + device_id
-            headers = {"Authorization": self.auth_entry.get()}
-            try:
-                json_data = requests.request(
-                    "GET",
-                    command_request,
-                    headers=headers,
-                    params=payload,
-                    timeout=self.timeout,
-                )
-                dict_data = json_data.json()
-                logging.info(dict_data)
-
-            except Exception as e:
-                logging.error(e)
-        return
-
-    def update_list_today(self):
+    def add_device(self, device_id):
+        device = self.registry.lookup(device_id)
+        logging.info("%s added", device_id)
+        self.controldevicelist[device_id] = {
+            "id": device_id,
+            "name": device["name"] if device else "",
+            "methods": device["methods"] if device else 0,
+        }
+        self.save_devices()
+        self.update_groups()
+        self.publish()
 
-        local_tz = get_localzone()
-        current_time = datetime.now(local_tz)
+    def remove_device(self, device_id):
+        logging.info("%s removed", device_id)
+        self.controldevicelist.pop(device_id, None)
+        self.save_devices()
+        self.update_groups()
+        self.publish()
 
-        sum_price = 0
-        highest = 0
-        lowest = 9999
+    def current_policy(self):
+        return Policy(
+            self.mode, self.fixed, self.ratio, self.min_on, self.max_switches
+        )
 
-        # Clear listbox here
-        self.pricelist.delete(0, 666)
+    def trigger_for(self, series, plan, policy):
 
-        # Loop for list
-        for index, hour in enumerate(self.todays_price):
+        # The price under which entries are on. With a plan this is the
+        # cheapest entry that is off, it is only used for showing the plan.
+        if policy.mode == "fixed":
+            return policy.price
+        off = [price for price, on in zip(series.prices, plan) if not on]
+        if off:
+            return min(off)
+        return series.highest + 0.01
 
-            time_start = datetime.fromisoformat(hour["time_start"])
-            time_end = datetime.fromisoformat(hour["time_end"])
+    def update_trigger(self):
+        policy = self.current_policy()
 
-            # this is just for printing the list nicely
-            time_parsed = datetime.strptime(hour["time_start"], "%Y-%m-%dT%H:%M:%S%z")
-            time_nice = time_parsed.strftime("%Y-%m-%d    %H:%M")
+        self.plan_today = self.planner.plan(self.todays_price, policy)
+        self.triggerprice = self.trigger_for(
+            self.todays_price, self.plan_today, policy
+        )
 
-            self.pricelist.insert(
-                index, str(f"{time_nice}    {hour['SEK_per_kWh']:.2f} SEK")
+        # tomorrows prices
+        if self.tomorrows_price is not None:
+            self.plan_tomorrow = self.planner.plan(self.tomorrows_price, policy)
+            self.triggerprice_tomorrow = self.trigger_for(
+                self.tomorrows_price, self.plan_tomorrow, policy
             )
+        else:
+            self.plan_tomorrow = None
+        logging.debug("%s: %s", self.mode, self.triggerprice)
+
+        # one plan per price day for each policy of a controlled device,
+        # {policy key: (today, tomorrow or None)}
+        policy_plans = {}
+        for key, device_ids in self.policy_devices.items():
+            policy = self.device_policies[device_ids[0]]
+            tomorrow = self.series_for(policy.area, 1)
+            policy_plans[key] = (
+                self.planner.plan(self.series_for(policy.area), policy),
+                self.planner.plan(tomorrow, policy) if tomorrow is not None else None,
+            )
+        self.policy_plans = policy_plans
+
+    def areas(self):
+
+        # The AREA setting first, then the areas of the controlled devices
+        areas = [self.area]
+        for device_ids in self.policy_devices.values():
+            area = self.device_policies[device_ids[0]].area
+            if area and area not in areas:
+                areas.append(area)
+        return areas
+
+    def series_for(self, area, day=0):
+
+        # day 0 is today and 1 tomorrow, which may be None
+        if area is None or area not in self.area_prices:
+            return self.tomorrows_price if day else self.todays_price
+        return self.area_prices[area][day]
+
+    def update_prices(self, time_now):
+
+        # Every area is loaded once, through the shared price cache
+        today = datetime.strftime(time_now, "%Y/%m-%d")
+        tomorrow = datetime.strftime(time_now + timedelta(1), "%Y/%m-%d")
+        area_prices = {}
+        for area in self.areas():
+            self.date_to_fetch = today
+            todays_price = self.getprice(area=area)
+            using_defaultprice = not todays_price
+            if using_defaultprice:
+                if not self.area_prices.get(area, (None, None, False))[2]:
+                    logging.error(
+                        "Fetching price list for %s failed. "
+                        "Using a generic price list.",
+                        area,
+                    )
+                todays_price = self.defaultprice()
 
-            sum_price += hour["SEK_per_kWh"]
-
-            # Here we check if the entry mathches the current time
-            if time_start < current_time and time_end > current_time:
-                self.pricelist.delete(index)
-                self.pricelist.insert(
-                    index,
-                    str(f"{time_nice}    {hour['SEK_per_kWh']:.2f} SEK    <-- Now"),
-                )
-                setattr(self, "pricenow", hour["SEK_per_kWh"])
+            # tomorrows prices are published in the early afternoon, there is
+            # no point asking for them before that
+            self.date_to_fetch = tomorrow
+            tomorrows_price = self.getprice(
+                fetch=time_now.hour >= self.publish_hour, area=area
+            )
+            area_prices[area] = (todays_price, tomorrows_price, using_defaultprice)
 
-            if self.triggerprice > hour["SEK_per_kWh"]:
-                self.pricelist.itemconfigure(index, background="#66ff66")
+        self.area_prices = area_prices
+        self.todays_price, self.tomorrows_price, self.using_defaultprice = (
+            area_prices[self.area]
+        )
 
-            if highest < hour["SEK_per_kWh"]:
-                highest = hour["SEK_per_kWh"]
+    def update_pricenow(self):
 
-            if lowest > hour["SEK_per_kWh"]:
-                lowest = hour["SEK_per_kWh"]
+        # with a pre-roll the price of the next interval is used a few seconds
+        # before it starts, to give the devices time to switch
+        current_time = self.clock() + self.preroll
 
-        avg_price = sum_price / len(self.todays_price)
-        self.avgpricecalc["text"] = f"{avg_price:.2f} SEK / KWh"
-        setattr(self, "highestprice", highest)
-        setattr(self, "lowestprice", lowest)
+        price = self.todays_price.price_at(current_time)
+        if price is None and self.tomorrows_price is not None:
+            price = self.tomorrows_price.price_at(current_time)
+        if price is not None:
+            self.pricenow = price
 
-        if self.tomorrows_price.__class__ == list:
-            for index, hour in enumerate(self.tomorrows_price):
-                if highest < hour["SEK_per_kWh"]:
-                    highest = hour["SEK_per_kWh"]
-            if highest > self.highestprice:
-                setattr(self, "highestprice", highest)
+        self.avgprice = self.todays_price.average
+        self.lowestprice = self.todays_price.lowest
 
-        self.graph.delete("all")
+        # the graph is scaled to the highest price of both days
+        self.highestprice = self.todays_price.highest
+        if self.tomorrows_price is not None:
+            self.highestprice = max(self.highestprice, self.tomorrows_price.highest)
 
         logging.debug("Highest: %s", self.highestprice)
         logging.debug("Lowest: %s", self.lowestprice)
 
-        # Loop for graph
-        for index, hour in enumerate(self.todays_price):
-
-            offset = 4
-            spacing = int(300 / len(self.todays_price))
-            bar_width = spacing - 1
-
-            max_height = 0.9
-
-            if self.highestprice != 0:
-                setattr(
-                    self, "scaling", self.graphheight / self.highestprice * max_height
-                )
-            # scaling = self.graphheight / hour['SEK_per_kWh']
+    def planned_on(self, area, plans, timestamp):
+
+        # The plan entry of the interval at timestamp, from tomorrow's plan
+        # once a pre-roll reaches past the end of today. None if no plan
+        # covers it.
+        for day, plan in enumerate(plans):
+            series = self.series_for(area, day)
+            if series is None:
+                continue
+            index = series.index_at(timestamp)
+            if index is not None:
+                if plan is None or index >= len(plan):
+                    return None
+                return bool(plan[index])
+        return None
+
+    def group_switch(self, on, lastaction, device_ids, commands):
+
+        # Adds the commands for one group of devices, returns the new state
+        # and if it is sent. Override/Repeat is left to resend.
+        if on:
+            state, method = "ON", "turnOn"
+        else:
+            state, method = "OFF", "turnOff"
+        if lastaction == state:
+            return state, False
+        commands.extend((device_id, method) for device_id in device_ids)
+        return state, True
+
+    def switch(self):
+
+        # Returns a short status for the last action of the devices that
+        # follow the main settings
+        ahead = self.clock() + self.preroll
+        commands = []
+
+        # without a plan for the moment the main settings compare the price,
+        # device policies keep their last state
+        on = self.planned_on(None, (self.plan_today, self.plan_tomorrow), ahead)
+        if on is None:
+            on = self.pricenow < self.triggerprice
+        state, send = self.group_switch(
+            on,
+            self.lastaction,
+            self.default_devices,
+            commands,
+        )
+        if send:
+            logging.info("Switching %s", state)
+            self.run_custom(state)
+            status = "Switching " + state
+        else:
+            logging.debug("Already %s", state)
+            status = state
+        self.lastaction = state
+
+        for key, device_ids in self.policy_devices.items():
+            area = self.device_policies[device_ids[0]].area
+            lastaction = self.lastactions.get(key, "")
+            on = self.planned_on(area, self.policy_plans.get(key, (None, None)), ahead)
+            if on is None:
+                on = lastaction == "ON"
+            state, send = self.group_switch(on, lastaction, device_ids, commands)
+            if send:
+                logging.info("Switching %s: %s", state, ", ".join(device_ids))
+            self.lastactions[key] = state
+
+        if commands:
+            self.send_commands(commands)
+        return status
+
+    def prefetch(self, time_now):
+
+        # At startup the missing days of every area are fetched at the same
+        # time instead of one after the other, so a cold start waits for one
+        # request timeout at most. update_prices then finds them in the
+        # archive.
+        days = [datetime.strftime(time_now, "%Y/%m-%d")]
+        if time_now.hour >= self.publish_hour:
+            days.append(datetime.strftime(time_now + timedelta(1), "%Y/%m-%d"))
+        jobs = []
+        for area in self.areas():
+            for date_to_fetch in days:
+                day = date_to_fetch.replace("/", "-")
+                log_filename = "log/" + day + "_" + area + ".json"
+                if os.path.isfile(log_filename):
+                    continue
+                if self.archive.get_day(area, day) is None:
+                    jobs.append((date_to_fetch, area))
+        if not jobs:
+            return
 
+        def fetch(date_to_fetch, area):
+            prices = self.fetchprice(date_to_fetch, area)
+            if prices is not None:
+                self.archive.put_day(area, date_to_fetch.replace("/", "-"), prices)
+            return prices
+
+        logging.info("Fetching %s price days", len(jobs))
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            futures = dict(
+                (pool.submit(fetch, date_to_fetch, area), (date_to_fetch, area))
+                for date_to_fetch, area in jobs
+            )
+            for future in as_completed(futures):
+                if future.result() is None:
+                    self.fetch_backoff.failed(futures[future])
+
+    def load_prices(self):
+        self.prefetch(self.now())
+        self.update_prices(self.now())
+        self.update_trigger()
+        self.update_pricenow()
+        self.loading = False
+        self.publish()
+
+    def tick(self):
+
+        # One pass of the control loop, shared by the window and headless mode
+        started = time.monotonic()
+        self.apply_settings()
+        self.update_prices(self.now())
+        self.update_trigger()  # Run this to update ratio in case of date change
+        self.update_pricenow()
+        self.loading = False
+        status = self.switch()
+
+        metrics.observe("price_control_tick_seconds", time.monotonic() - started)
+        metrics.set("price_control_last_tick_timestamp_seconds", round(self.clock()))
+        metrics.set("price_control_devices", len(self.controldevicelist))
+        for area, prices in self.area_prices.items():
+            metrics.set("price_control_default_prices", int(prices[2]), area=area)
+        self.write_metrics()
+        self.publish()
+        return status
+
+    def queue_settings(self, changes):
+
+        # Settings from the API or the window. They are checked here and applied
+        # by the next tick, so they never change under a running one. Raises
+        # ValueError.
+        if not isinstance(changes, dict) or not changes:
+            raise ValueError("Expected an object with mode, ratio or price")
+        checked = {}
+        for key, value in changes.items():
+            if key == "mode":
+                if value not in ("fixed", "ratio", "block"):
+                    raise ValueError("mode must be fixed, ratio or block")
+                checked[key] = value
+            elif key == "ratio":
+                if isinstance(value, bool) or not isinstance(value, int):
+                    raise ValueError("ratio must be a whole number of hours")
+                if not 0 <= value <= 24:
+                    raise ValueError("ratio must be 0-24")
+                checked[key] = value
+            elif key == "price":
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    raise ValueError("price must be a number")
+                # spot prices can go below zero, so can the trigger
+                if not math.isfinite(value):
+                    raise ValueError("price must be a finite number")
+                checked[key] = float(value)
             else:
-                setattr(self, "scaling", 100)
-                logging.debug("Division by zero, setting scaling to 100")
-
-            bar_start_x = index * spacing + offset
-
-            bar_height = hour["SEK_per_kWh"] * self.scaling
-            bar_start_y = self.graphheight - bar_height
+                raise ValueError("Unknown setting: " + str(key))
+        with self.settings_lock:
+            self.pending_settings.update(checked)
+        logging.info("Queued settings: %s", checked)
+        self.woken.set()
+        return checked
+
+    def apply_settings(self):
+        with self.settings_lock:
+            changes = self.pending_settings
+            self.pending_settings = {}
+        if not changes:
+            return
+        self.mode = changes.get("mode", self.mode)
+        self.ratio = changes.get("ratio", self.ratio)
+        self.fixed = changes.get("price", self.fixed)
+        self.settings_version += 1
 
-            bar_end_x = bar_start_x + bar_width
-            bar_end_y = self.graphheight
+    def api_documents(self):
 
-            if self.triggerprice <= hour["SEK_per_kWh"]:
-                self.graph.create_rectangle(
-                    bar_start_x,
-                    bar_start_y,
-                    bar_end_x,
-                    bar_end_y,
-                    fill="red",
-                    outline="",
-                )
+        # What the API answers, by path
+        local_tz = get_localzone()
 
-            else:
-                self.graph.create_rectangle(
-                    bar_start_x,
-                    bar_start_y,
-                    bar_end_x,
-                    bar_end_y,
-                    fill="#66ff66",
-                    outline="",
-                )
+        def intervals(series):
+            if series is None:
+                return None
+            return [
+                {
+                    "start": datetime.fromtimestamp(start, local_tz).isoformat(),
+                    "end": datetime.fromtimestamp(end, local_tz).isoformat(),
+                    "price": price,
+                }
+                for start, end, price in zip(series.starts, series.ends, series.prices)
+            ]
+
+        status = {
+            "version": VERSION,
+            "loading": self.loading,
+            "mode": self.mode,
+            "price": self.fixed,
+            "ratio": self.ratio,
+            "area": self.area,
+            "override": self.override == "ON",
+            "price_now": self.pricenow,
+            "average": self.avgprice,
+            "lowest": self.lowestprice,
+            "highest": self.highestprice,
+            "trigger": self.triggerprice,
+            "trigger_tomorrow": (
+                self.triggerprice_tomorrow if self.plan_tomorrow is not None else None
+            ),
+            "default_prices": self.using_defaultprice,
+            "last_action": self.lastaction,
+        }
+
+        prices = {}
+        for area, (today, tomorrow, using_default) in self.area_prices.items():
+            prices[area] = {
+                "today": intervals(today),
+                "tomorrow": intervals(tomorrow),
+                "default_prices": using_default,
+            }
+
+        # plans are 1 for on and 0 for off, one per interval of /prices
+        plans = [
+            {
+                "policy": self.current_policy().label(),
+                "area": self.area,
+                "devices": self.default_devices,
+                "today": list(self.plan_today),
+                "tomorrow": (
+                    list(self.plan_tomorrow) if self.plan_tomorrow is not None else None
+                ),
+                "last_action": self.lastaction,
+            }
+        ]
+        policies = {}
+        for key, device_ids in self.policy_devices.items():
+            policy = self.device_policies[device_ids[0]]
+            plan, plan_tomorrow = self.policy_plans.get(key, (None, None))
+            policies.update((device_id, (policy, key)) for device_id in device_ids)
+            plans.append(
+                {
+                    "policy": policy.label(),
+                    "area": policy.area or self.area,
+                    "devices": device_ids,
+                    "today": list(plan) if plan is not None else None,
+                    "tomorrow": (
+                        list(plan_tomorrow) if plan_tomorrow is not None else None
+                    ),
+                    "last_action": self.lastactions.get(key, ""),
+                }
+            )
 
-        self.graph.create_rectangle(
-            295, 0, 600, self.graphheight, fill="light gray", outline=""
-        )
-        if not self.tomorrows_price.__class__ == list:
-            self.graph.create_text(
-                400, 120, text="Tomorrows price\nnot yet available", fill="gray"
+        devices = []
+        for device_id, device in list(self.controldevicelist.items()):
+            policy, key = policies.get(device_id, (None, None))
+            devices.append(
+                {
+                    "id": device_id,
+                    "gateway": split_key(device_id)[0],
+                    "name": device["name"],
+                    "methods": device["methods"],
+                    "state": self.registry.state(device_id),
+                    "policy": (policy or self.current_policy()).label(),
+                    "last_action": (
+                        self.lastactions.get(key, "") if policy else self.lastaction
+                    ),
+                }
             )
 
-        if self.controltype.get() == "fixed":
-            startx = 0
-            starty = self.graphheight - self.triggerprice * self.scaling
-            endx = self.graphwidth
-            endy = starty
-            self.graph.create_line(startx, starty, endx, endy, width="2", fill="blue")
+        return {
+            "/status": status,
+            "/prices": prices,
+            "/plan": plans,
+            "/devices": devices,
+        }
 
-    def update_list_tomorrow(self):
+    def publish(self):
 
-        # Loop for list
-        for index, hour in enumerate(self.tomorrows_price):
+        # The API answers are serialised once per change instead of once per
+        # request. The ETag is a hash of the body, so it only changes with it.
+        if not self.api_port:
+            return
+        with self.publish_lock:
+            responses = {}
+            for path, document in self.api_documents().items():
+                body = json.dumps(document, sort_keys=True).encode("utf-8")
+                etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+                responses[path] = (etag, body)
+            self.responses = responses
+
+    def start_api(self):
+
+        # The status API, off unless API_PORT is set
+        if not self.api_port:
+            return None
+        from price_control_server import ApiHandler, start_server
+
+        self.publish()
+        try:
+            server = start_server(
+                self.api_address,
+                self.api_port,
+                ApiHandler,
+                "api",
+                engine=self,
+                metrics=metrics,
+            )
+        except OSError as e:
+            logging.error("Could not start the API: %s", e)
+            return None
+        logging.info("API on http://%s:%s/status", self.api_address, self.api_port)
+        return server
 
-            # this is just for printing the list nicely
-            time_parsed = datetime.strptime(hour["time_start"], "%Y-%m-%dT%H:%M:%S%z")
-            time_nice = time_parsed.strftime("%Y-%m-%d    %H:%M")
+    def start_metrics(self):
 
-            self.pricelist.insert(
-                index + len(self.todays_price),
-                str(f"{time_nice}    {hour['SEK_per_kWh']:.2f} SEK"),
-            )
+        # The Prometheus endpoint, off unless METRICS_PORT is set
+        if not self.metrics_port:
+            return None
+        from price_control_server import MetricsHandler, start_server
 
-            if self.controltype.get() == "ratio":
-                if self.triggerprice_tomorrow > hour["SEK_per_kWh"]:
-                    self.pricelist.itemconfigure(
-                        index + len(self.todays_price), background="#66ff66"
-                    )
-            else:
-                if self.triggerprice > hour["SEK_per_kWh"]:
-                    self.pricelist.itemconfigure(
-                        index + len(self.todays_price), background="#66ff66"
-                    )
+        try:
+            server = start_server(
+                self.metrics_address,
+                self.metrics_port,
+                MetricsHandler,
+                "metrics",
+                metrics=metrics,
+            )
+        except OSError as e:
+            logging.error("Could not start the metrics endpoint: %s", e)
+            return None
+        logging.info(
+            "Metrics on http://%s:%s/metrics", self.metrics_address, self.metrics_port
+        )
+        return server
 
-        # Loop for graph
-        for index, hour in enumerate(self.tomorrows_price):
+    def write_metrics(self):
 
-            offset = 300
-            # spacing = 12
-            spacing = int(300 / len(self.tomorrows_price))
-            bar_width = spacing - 1
+        # The metrics file is replaced in one go, so a reader never sees half
+        if not self.metrics_file:
+            return
+        temp = self.metrics_file + ".tmp"
+        try:
+            with open(temp, "w", encoding="utf-8") as file:
+                file.write(metrics.render())
+            os.replace(temp, self.metrics_file)
+        except OSError as e:
+            logging.error("Could not write %s: %s", self.metrics_file, e)
+
+    def next_wakeup(self):
+
+        # Seconds until the next tick is needed. Prices only change at the
+        # start of an interval, so there is nothing to do between them except
+        # fetching missing prices. The time is worked out from the wall clock
+        # on every tick, so a slow tick does not make the next one late. All
+        # of it is in epoch seconds, local datetimes would lose the repeated
+        # hour when DST ends.
+        local_tz = get_localzone()
+        now_ts = self.clock()
+        now = datetime.fromtimestamp(now_ts, local_tz)
+        ahead = now_ts + self.preroll
+        targets = [now_ts + self.max_sleep]
+
+        # every area is scheduled on its own boundaries
+        today = datetime.strftime(now, "%Y/%m-%d")
+        tomorrow = datetime.strftime(now + timedelta(1), "%Y/%m-%d")
+        publish = datetime(now.year, now.month, now.day, self.publish_hour)
+        publish = publish.replace(tzinfo=local_tz).timestamp()
+        for area, prices in self.area_prices.items():
+            todays_price, tomorrows_price, using_defaultprice = prices
+            for day in (todays_price, tomorrows_price):
+                if day is None:
+                    continue
+                boundary = day.next_boundary(ahead)
+                if boundary is not None:
+                    targets.append(boundary - self.preroll)
+
+            # missing prices are retried when the backoff allows it
+            if not self.fetch_prices:
+                continue
+            if using_defaultprice:
+                wait = max(self.fetch_backoff.wait((today, area)), 1)
+                targets.append(now_ts + wait)
+
+            if tomorrows_price is None:
+                if now_ts < publish:
+                    targets.append(publish)
+                else:
+                    wait = max(self.fetch_backoff.wait((tomorrow, area)), 1)
+                    targets.append(now_ts + wait)
+
+        return max(min(targets) - now_ts, 0.05)
+
+    def now(self, tz=None):
+        return datetime.fromtimestamp(self.clock(), tz)
+
+    def resend(self):
+
+        # Repeats the last action for the Override/Repeat setting, without
+        # looking at the prices again
+        commands = []
+        groups = [(self.lastaction, self.default_devices)]
+        for key, device_ids in self.policy_devices.items():
+            groups.append((self.lastactions.get(key, ""), device_ids))
+        for lastaction, device_ids in groups:
+            if lastaction in ("ON", "OFF"):
+                self.group_switch(lastaction == "ON", "", device_ids, commands)
+
+        logging.debug("Repeating %s", self.lastaction)
+        self.run_custom(self.lastaction)
+        commands = self.drifted(commands)
+        if commands:
+            self.send_commands(commands)
+        self.write_metrics()
+        self.publish()
+
+    def drifted(self, commands):
+
+        # Only the devices whose state differs from the command are sent to,
+        # read from the TellStick in one call. Every RESYNC_INTERVAL seconds,
+        # or if the states can not be read, all commands are sent.
+        now = time.monotonic()
+        if self.resync_interval and now >= self.next_resync:
+            self.next_resync = now + self.resync_interval
+            logging.debug("Full resync of %s devices", len(commands))
+            return commands
+
+        if self.registry.refresh() is None:
+            return commands
+
+        drifted = []
+        for device_id, method in commands:
+            state = self.registry.state(device_id)
+            if state != ("ON" if method == "turnOn" else "OFF"):
+                drifted.append((device_id, method))
+        metrics.inc("price_control_drifted_devices_total", len(drifted))
+        logging.debug("%s of %s devices drifted", len(drifted), len(commands))
+        return drifted
+
+    def gateway(self, name):
+
+        # (tell_api, auth) of a gateway, the one in the APP section has no name
+        if not name:
+            return self.tell_api, self.auth
+        return self.gateways[name]["tell_api"], self.gateways[name]["auth"]
+
+    def fetch_devices(self):
+
+        # The device lists of all gateways at once
+        futures = {}
+        for name in [""] + list(self.gateways):
+            tell_api, auth = self.gateway(name)
+            futures[name] = self.dispatcher.get_pool(tell_api).submit(
+                self.dispatcher.list_devices, tell_api, auth, self.timeout
+            )
+        listed = {}
+        for name, future in futures.items():
+            devices = future.result()
+            for device in devices or []:
+                device["id"] = device_key(name, device["id"])
+                device["gateway"] = name
+            listed[name] = devices
+        return listed
+
+    def list_devices(self):
+
+        # The Refresh button, always asks the TellStick
+        devices = self.registry.refresh()
+        if devices is None:
+            logging.error("No devices in response.")
+        return devices
+
+    def known_devices(self):
+        return self.registry.get()
+
+    def device_command(self, device_id, method):
+        result = self.send_commands([(device_id, method)])[0]
+        logging.info(result["reply"])
+        return result
+
+    def send_commands(self, commands):
+
+        # commands is a list of (device key, method). They are split up by
+        # gateway and all gateways are sent to at the same time.
+        groups = {}
+        results = []
+        for key, method in commands:
+            gateway, device_id = split_key(key)
+            if gateway and gateway not in self.gateways:
+                logging.error("%s: no gateway %s in settings.ini", key, gateway)
+                results.append(
+                    {
+                        "id": device_id,
+                        "device": key,
+                        "method": method,
+                        "ok": False,
+                        "reply": "Unknown gateway " + gateway,
+                    }
+                )
+                continue
+            groups.setdefault(gateway, []).append((key, device_id, method))
+
+        batches = []
+        for gateway, group in groups.items():
+            tell_api, auth = self.gateway(gateway)
+            commands = [(device_id, method) for _, device_id, method in group]
+            batches.append((tell_api, auth, self.timeout, commands))
+        for group, batch_results in zip(
+            groups.values(), self.dispatcher.dispatch_many(batches)
+        ):
+            for (key, _, _), result in zip(group, batch_results):
+                result["device"] = key
+                results.append(result)
+        self.registry.record(results)
+        return results
+
+    def run_custom(self, state):
+
+        if state == "ON":
+            command = self.oncommand
+        elif state == "OFF":
+            command = self.offcommand
+        else:
+            return
 
-            max_height = 0.9
+        if command:
+            self.custom.run(state, command)
 
-            setattr(self, "scaling", self.graphheight / self.highestprice * max_height)
+    def day_changed(self, area, day):
 
-            bar_start_x = index * spacing + offset
+        # The archive has days as 2023-01-15, the cache as 2023/01-15
+        self.price_cache.drop((day.replace("-", "/", 1), area))
 
-            bar_height = hour["SEK_per_kWh"] * self.scaling
-            bar_start_y = self.graphheight - bar_height
+    def getprice(self, fetch=True, area=None):
 
-            bar_end_x = bar_start_x + bar_width
-            bar_end_y = self.graphheight
+        if area is None:
+            area = self.area
+        day = self.date_to_fetch.replace("/", "-")
+        cache_key = (self.date_to_fetch, area)
 
-            if self.controltype.get() == "ratio":
-                if self.triggerprice_tomorrow <= hour["SEK_per_kWh"]:
-                    # fixed or ratio
-                    self.graph.create_rectangle(
-                        bar_start_x,
-                        bar_start_y,
-                        bar_end_x,
-                        bar_end_y,
-                        fill="red",
-                        outline="",
-                    )
+        series = self.price_cache.get(cache_key)
+        if series is not None:
+            return series
 
-                else:
-                    self.graph.create_rectangle(
-                        bar_start_x,
-                        bar_start_y,
-                        bar_end_x,
-                        bar_end_y,
-                        fill="#66ff66",
-                        outline="",
-                    )
+        prices = self.archive.get_day(area, day)
 
-            if self.controltype.get() == "fixed":
-                if self.triggerprice <= hour["SEK_per_kWh"]:
-                    # fixed or ratio
-                    self.graph.create_rectangle(
-                        bar_start_x,
-                        bar_start_y,
-                        bar_end_x,
-                        bar_end_y,
-                        fill="red",
-                        outline="",
-                    )
+        # a day file put in log/ by hand, like one from make_dummy_json.py
+        log_filename = "log/" + day + "_" + area + ".json"
+        if prices is None and os.path.isfile(log_filename):
+            logging.debug("Reading from local file %s", log_filename)
+            self.archive.import_file(log_filename)
+            prices = self.archive.get_day(area, day)
 
-                else:
-                    self.graph.create_rectangle(
-                        bar_start_x,
-                        bar_start_y,
-                        bar_end_x,
-                        bar_end_y,
-                        fill="#66ff66",
-                        outline="",
-                    )
+        if prices is None:
+            if not fetch or not self.fetch_prices:
+                logging.debug("Prices for %s are not published yet", day)
+                return
+            if not self.fetch_backoff.ready(cache_key):
+                logging.debug("Waiting before fetching %s again", day)
+                return
 
-        if self.controltype.get() == "fixed":
-            startx = 0
-            starty = self.graphheight - self.triggerprice * self.scaling
-            endx = self.graphwidth
-            endy = starty
-            self.graph.create_line(startx, starty, endx, endy, width="2", fill="blue")
+            prices = self.fetchprice(self.date_to_fetch, area)
+            if prices is None:
+                self.fetch_backoff.failed(cache_key)
+                return
+            self.fetch_backoff.succeeded(cache_key)
+            self.archive.put_day(area, day, prices)
 
-    def getprice(self):
+        series = PriceSeries(prices)
+        if not series:
+            return None
+        self.price_cache.put(cache_key, series)
+        return series
 
-        log_filename = self.date_to_fetch + "_" + self.area + ".json"
-        log_filename = log_filename.replace("/", "-")
+    def fetchprice(self, date_to_fetch, area, session=None):
+        import requests
 
-        if not os.path.exists("log/"):
-            logging.info("Creating price log folder")
-            os.mkdir("log")
+        if session is None:
+            session = requests
 
-        if not os.path.isfile("log/" + log_filename):
-            logging.info("Creating price log file")
+        # GET https://www.elprisetjustnu.se/api/v1/prices/2023/01-15_SE3.json
+        command_request = self.el_api + date_to_fetch + "_" + area + ".json"
 
-            # GET https://www.elprisetjustnu.se/api/v1/prices/2023/01-15_SE3.json
-            command_request = (
-                self.el_api + self.date_to_fetch + "_" + self.area + ".json"
+        started = time.monotonic()
+        outcome = "error"
+        try:
+            json_data = session.request(
+                "GET",
+                command_request,
+                headers="",
+                data="",
+                timeout=self.request_timeout,
             )
 
-            try:
-                json_data = requests.request(
-                    "GET",
-                    command_request,
-                    headers="",
-                    data="",
-                    timeout=self.request_timeout,
-                )
+            if json_data.ok:
+                prices = json_data.json()
+                if not isinstance(prices, list):
+                    raise ValueError("not a list of prices")
+                if not prices:
+                    raise ValueError("no prices in the list")
+                logging.info("Fetching %s OK", command_request)
+                outcome = "ok"
+                return prices
 
-                if json_data.ok:
-                    logging.info("Fetching %s OK", command_request)
-                    with open("log/" + log_filename, "w") as fp:
+            else:
+                outcome = "http_" + str(json_data.status_code)
+                logging.info(
+                    "Fetching " + command_request + " failed: " + json_data.reason
+                )
 
-                        json.dump(json_data.json(), fp, indent=2)
-                        # fp.write(write)
-                        return json_data.json()
+        except requests.exceptions.ConnectionError as e:
+            logging.error("Connection error: %s", e)
 
-                else:
-                    logging.info(
-                        "Fetching " + command_request + " failed: " + json_data.reason
-                    )
-                    return
+        except requests.exceptions.ReadTimeout as e:
+            outcome = "timeout"
+            logging.error(f"Read timed out: {e}")
 
-            except requests.exceptions.ConnectionError as e:
-                logging.error("Connection error: %s", e)
+        # a page that is not JSON, a broken transfer, redirect loops...
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.error("Fetching %s failed: %s", command_request, e)
 
-            except requests.exceptions.ReadTimeout as e:
-                logging.error(f"Read timed out: {e}")
+        finally:
+            metrics.observe(
+                "price_control_price_fetch_seconds",
+                time.monotonic() - started,
+                area=area,
+            )
+            metrics.inc("price_control_price_fetches_total", area=area, result=outcome)
 
-        if os.path.isfile("log/" + log_filename):
-            with open(r"log/" + log_filename, "r") as fp:
-                logging.debug("Reading from local file %s", log_filename)
-                return json.load(fp)
+        return None
 
     def defaultprice(self):
+        current_date = date.fromtimestamp(self.clock())
+        if self.default_series is not None and self.default_series[0] == current_date:
+            return self.default_series[1]
+
         i = 0
         default_price = []
-        current_date = date.today()
-        current_date = current_date.strftime("%Y-%m-%d")
         while i < 24:
-            timeString = f"{current_date}T{i}:00:00+02:00"
+            time_start = datetime(
+                current_date.year, current_date.month, current_date.day, i
+            ).astimezone()
+            time_end = time_start + timedelta(hours=1)
             if (i % 2) == 0:
-                default_price.append({"SEK_per_kWh": i / 100, "time_start": timeString})
+                price = i / 100
             else:
-                default_price.append(
-                    {"SEK_per_kWh": 4.00 + i / 100, "time_start": timeString}
-                )
+                price = 4.00 + i / 100
+            default_price.append(
+                {
+                    "SEK_per_kWh": price,
+                    "time_start": time_start.isoformat(),
+                    "time_end": time_end.isoformat(),
+                }
+            )
             i += 1
-        return default_price
+        self.default_series = (current_date, PriceSeries(default_price))
+        return self.default_series[1]
 
 
-def main():
+def run_headless(engine):
 
-    mainwindow = MainWindowBuilder()
-    # mainwindow.iconbitmap("sausage_icon_211243.ico")
+    logging.info("Running headless, no window will be opened")
+
+    # The device states in /devices come from the registry, which the window
+    # would otherwise fill
+    try:
+        if engine.registry.refresh() is None:
+            logging.error("No devices in response.")
+    except Exception:
+        logging.exception("Listing the devices failed")
+
+    logging.info("Loading prices")
+    try:
+        engine.load_prices()
+    except Exception:
+        logging.exception("Loading prices failed, trying again at the next update")
+
+    # An unexpected error in one update must not stop the service. The next
+    # try waits longer after every failure in a row, up to 5 minutes.
+    resend_interval = engine.delayseconds / 1000
+    failures = 0
+    while True:
+        engine.woken.clear()
+        try:
+            status = engine.tick()
+        except Exception:
+            failures += 1
+            delay = min(10 * 2 ** (failures - 1), 300)
+            logging.exception("Update failed, trying again in %s seconds", delay)
+            engine.woken.wait(delay)
+            continue
+        failures = 0
+        logging.debug("Last action: %s", status)
+
+        # sleep until the next price interval, repeating the last action in
+        # between if Override/Repeat is on. Settings from the API wake it.
+        wakeup = time.monotonic() + engine.next_wakeup()
+        next_resend = time.monotonic() + resend_interval
+        logging.debug("Waiting for %.1f seconds.", wakeup - time.monotonic())
+        while time.monotonic() < wakeup:
+            if engine.override == "ON" and next_resend < wakeup:
+                if engine.woken.wait(max(0, next_resend - time.monotonic())):
+                    break
+                try:
+                    engine.resend()
+                except Exception:
+                    logging.exception("Resending the last action failed")
+                next_resend = time.monotonic() + resend_interval
+            elif engine.woken.wait(max(0, wakeup - time.monotonic())):
+                break
+
+
+def backfill(engine, first_day, last_day, areas, workers, rate):
+
+    # Fetches historical prices into the archive. Days already in the
+    # archive are skipped, so an interrupted backfill picks up where it
+    # stopped when run again.
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    limiter = RateLimiter(rate)
+
+    jobs = []
+    for area in areas:
+        done = engine.archive.days(area)
+        day = first_day
+        while day <= last_day:
+            if day.isoformat() not in done:
+                jobs.append((day, area))
+            day += timedelta(1)
+    print(f"Backfilling {len(jobs)} days, {workers} at a time")
+
+    def fetch(day, area):
+        limiter.wait()
+        return engine.fetchprice(day.strftime("%Y/%m-%d"), area, session)
+
+    failed = []
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(fetch, day, area): (day, area) for day, area in jobs}
+        for count, future in enumerate(as_completed(futures), 1):
+            day, area = futures[future]
+            prices = future.result()
+            if prices:
+                engine.archive.put_day(area, day.isoformat(), prices)
+            else:
+                failed.append((day, area))
+            if count % 50 == 0 or count == len(jobs):
+                print(
+                    f"{count}/{len(jobs)} days, {len(failed)} failed, "
+                    + f"{time.monotonic() - started:.1f} s"
+                )
 
-    time_now = datetime.now()
-    mainwindow.date_to_fetch = datetime.strftime(time_now, "%Y/%m-%d")
-    todays_price = mainwindow.getprice()
-    if todays_price:
-        mainwindow.todays_price = todays_price
+    for day, area in sorted(failed):
+        print(f"Missing {day.isoformat()} {area}")
+    return failed
+
+
+def replay(engine, first_day, last_day, entries, speed, output):
+
+    # Runs the control loop from first_day to last_day on a clock that jumps
+    # straight to the next wakeup, with the saved devices and policies.
+    # Commands go to recording stub TellSticks, one per gateway, and the
+    # custom commands are not run. Prices come from the archive, or with
+    # entries from a stub price API serving synthetic days with that many
+    # intervals. speed paces the replay, 0 runs it as fast as possible.
+    from stubs import StubPriceAPI, StubTellStick
+
+    local_tz = get_localzone()
+    start = datetime(first_day.year, first_day.month, first_day.day, tzinfo=local_tz)
+    end = datetime(last_day.year, last_day.month, last_day.day) + timedelta(1)
+    end = end.replace(tzinfo=local_tz).timestamp()
+
+    clock = ReplayClock(start.timestamp())
+    engine.clock = clock
+    engine.oncommand = ""
+    engine.offcommand = ""
+    tellsticks = {"": StubTellStick(0, clock=clock).start()}
+    engine.tell_api = tellsticks[""].address
+    for name, gateway in engine.gateways.items():
+        tellsticks[name] = StubTellStick(0, clock=clock).start()
+        gateway["tell_api"] = tellsticks[name].address
+        engine.dispatcher.limits[gateway["tell_api"]] = gateway["workers"]
+    price_api = None
+    if entries:
+        price_api = StubPriceAPI(entries).start()
+        engine.el_api = price_api.el_api
+        engine.archive = PriceArchive(":memory:", engine.day_changed)
     else:
-        mainwindow.todays_price = mainwindow.defaultprice()
-        logging.error("Fetching price list failed. Using a generic price list.")
-    mainwindow.areatext["text"] = mainwindow.area
+        engine.fetch_prices = False
+
+    ticks = 0
+    started = time.monotonic()
+    while clock() < end:
+        engine.tick()
+        ticks += 1
+        wait = engine.next_wakeup()
+        if speed > 0:
+            time.sleep(wait / speed)
+        clock.advance(wait)
+    elapsed = time.monotonic() - started
+
+    commands = []
+    for name, tellstick in tellsticks.items():
+        tellstick.stop()
+        commands.extend(
+            (when, device_key(name, device_id), method)
+            for when, device_id, method in tellstick.commands
+        )
+    if price_api is not None:
+        price_api.stop()
+
+    commands.sort()
+    for when, device_id, method in commands:
+        when = datetime.fromtimestamp(when, local_tz).isoformat(timespec="seconds")
+        output.write(f"{when},{device_id},{method}\n")
+    output.flush()
+
+    days = (last_day - first_day).days + 1
+    print(
+        f"{days} days, {ticks} ticks, {len(commands)} commands "
+        + f"in {elapsed:.1f} s ({days * 86400 / max(elapsed, 0.001):.0f}x)",
+        file=sys.stderr,
+    )
+    return commands
+
+
+def backtest_days(rows):
+
+    # Groups archive rows into {day: (entry length in seconds, prices)}
+    days = OrderedDict()
+    for day, start_time, end_time, sek in rows:
+        if day not in days:
+            days[day] = (end_time - start_time, array("d"))
+        days[day][1].append(sek)
+    return days
+
+
+def backtest_job(path, area, first_day, last_day, policies, power):
+
+    # Runs in a worker process, so it opens the archive itself. Every day is
+    # sorted and summed once, after that the cost of a fixed price, best hours
+    # or best block policy is a lookup in the sums. Only MIN_ON and
+    # MAX_SWITCHES need a plan entry by entry, from the same Planner as the
+    # control loop.
+    archive = PriceArchive(path)
+    rows = archive.prices(area, first_day.isoformat(), last_day.isoformat())
+    archive.connection.close()
+
+    planner = Planner()
+    results = dict((policy.key(), []) for policy in policies)
+    for day, (interval, prices) in backtest_days(rows).items():
+        hours = interval / 3600
+        ordered = sorted(prices)
+        sorted_sums = list(accumulate(ordered, initial=0))
+        sums = list(accumulate(prices, initial=0))
+        average = sums[-1] / len(prices)
+
+        for policy in policies:
+            count = min(len(prices), max(0, round(policy.ratio * 3600 / interval)))
+            if policy.mode == "fixed":
+                count = bisect_left(ordered, policy.price)
+                total = sorted_sums[count]
+            elif policy.mode == "block":
+                total = min(
+                    sums[start + count] - sums[start]
+                    for start in range(len(prices) - count + 1)
+                )
+            elif policy.min_on or policy.max_switches:
+                plan = planner.ratio_plan(prices, interval, policy)
+                count = sum(plan)
+                total = sum(price for price, on in zip(prices, plan) if on)
+            else:
+                total = sorted_sums[count]
+
+            # savings are against using the same energy spread over the
+            # whole day, like a device that is always on
+            energy = count * hours * power
+            cost = total * hours * power
+            results[policy.key()].append(
+                (day, count * hours, energy, cost, energy * average - cost)
+            )
+    return area, results
+
+
+def backtest(engine, first_day, last_day, areas, policies, power, workers, output):
+
+    # Works out what the policies would have cost on the archived days. Areas,
+    # and parts of a long list of policies, run in a pool of processes.
+    from concurrent.futures import ProcessPoolExecutor
+
+    chunks = max(1, workers // len(areas))
+    parts = [policies[index::chunks] for index in range(chunks)]
+    jobs = [(area, part) for area in areas for part in parts if part]
+
+    started = time.monotonic()
+    results = dict((area, {}) for area in areas)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(
+                backtest_job,
+                engine.archive.path,
+                area,
+                first_day,
+                last_day,
+                part,
+                power,
+            )
+            for area, part in jobs
+        ]
+        for future in as_completed(futures):
+            area, days = future.result()
+            results[area].update(days)
+
+    print(f"{len(jobs)} jobs in {time.monotonic() - started:.1f} s")
+    writer = csv.writer(output) if output else None
+    if writer:
+        writer.writerow(
+            [
+                "area",
+                "policy",
+                "day",
+                "on_hours",
+                "energy_kwh",
+                "cost_sek",
+                "savings_sek",
+            ]
+        )
+    for area in areas:
+        for policy in policies:
+            days = results[area][policy.key()]
+            if not days:
+                print(f"{area} {policy.label()}: no prices in the archive")
+                continue
+            on_hours = sum(row[1] for row in days)
+            energy = sum(row[2] for row in days)
+            cost = sum(row[3] for row in days)
+            savings = sum(row[4] for row in days)
+            average = cost / energy if energy else 0
+            print(
+                f"{area} {policy.label():<28} {len(days)} days  "
+                + f"{on_hours:8.1f} h  {cost:10.2f} SEK  "
+                + f"{average:6.3f} SEK/kWh  saved {savings:9.2f} SEK"
+            )
+            if writer:
+                for day, hours, day_energy, day_cost, day_savings in days:
+                    writer.writerow(
+                        [
+                            area,
+                            policy.label(),
+                            day,
+                            f"{hours:.2f}",
+                            f"{day_energy:.3f}",
+                            f"{day_cost:.4f}",
+                            f"{day_savings:.4f}",
+                        ]
+                    )
+    return results
+
+
+def hour_range(text):
+
+    # "6" or "1-23"
+    first, _, last = text.partition("-")
+    return list(range(int(first), int(last or first) + 1))
+
+
+def main():
 
-    tomorrow = time_now + timedelta(1)
-    mainwindow.date_to_fetch = datetime.strftime(tomorrow, "%Y/%m-%d")
-    mainwindow.tomorrows_price = mainwindow.getprice()
+    parser = argparse.ArgumentParser(description="Telldus Price Control " + VERSION)
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="run the price control loop without the Tk window",
+    )
+    commands = parser.add_subparsers(dest="command")
+
+    backfill_parser = commands.add_parser(
+        "backfill", help="fetch historical prices into the price archive"
+    )
+    backfill_parser.add_argument(
+        "first", type=date.fromisoformat, help="first day, YYYY-MM-DD"
+    )
+    backfill_parser.add_argument(
+        "last", type=date.fromisoformat, help="last day, YYYY-MM-DD"
+    )
+    backfill_parser.add_argument(
+        "--area",
+        nargs="+",
+        choices=["SE1", "SE2", "SE3", "SE4"],
+        help="price areas, the AREA setting if left out",
+    )
+    backfill_parser.add_argument(
+        "--workers", type=int, default=4, help="requests running at the same time"
+    )
+    backfill_parser.add_argument(
+        "--rate", type=float, default=5, help="most requests per second"
+    )
+
+    replay_parser = commands.add_parser(
+        "replay",
+        help="run days through the control loop on a fast clock against a "
+        + "recording stub TellStick",
+    )
+    replay_parser.add_argument(
+        "first", type=date.fromisoformat, help="first day, YYYY-MM-DD"
+    )
+    replay_parser.add_argument(
+        "last", type=date.fromisoformat, help="last day, YYYY-MM-DD"
+    )
+    replay_parser.add_argument(
+        "--synthetic",
+        type=int,
+        metavar="ENTRIES",
+        help="use synthetic days with this many intervals instead of the archive",
+    )
+    replay_parser.add_argument(
+        "--speed",
+        type=float,
+        default=0,
+        help="times real speed, 0 for as fast as possible",
+    )
+    replay_parser.add_argument(
+        "--output", help="CSV file for the commands, stdout if left out"
+    )
+
+    backtest_parser = commands.add_parser(
+        "backtest", help="work out what policies would have cost on archived days"
+    )
+    backtest_parser.add_argument(
+        "first", type=date.fromisoformat, help="first day, YYYY-MM-DD"
+    )
+    backtest_parser.add_argument(
+        "last", type=date.fromisoformat, help="last day, YYYY-MM-DD"
+    )
+    backtest_parser.add_argument(
+        "--area",
+        nargs="+",
+        choices=["SE1", "SE2", "SE3", "SE4"],
+        help="price areas, the AREA setting if left out",
+    )
+    backtest_parser.add_argument(
+        "--mode",
+        nargs="+",
+        choices=["fixed", "ratio", "block"],
+        help="control modes, the MODE setting if left out",
+    )
+    backtest_parser.add_argument(
+        "--price",
+        type=float,
+        nargs="+",
+        help="trigger prices for fixed mode, the PRICE setting if left out",
+    )
+    backtest_parser.add_argument(
+        "--ratio",
+        type=hour_range,
+        nargs="+",
+        help="hours for ratio and block mode like 6 or 1-23, "
+        + "the RATIO setting if left out",
+    )
+    backtest_parser.add_argument(
+        "--power", type=float, default=1, help="power of the devices in kW"
+    )
+    backtest_parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="processes to use"
+    )
+    backtest_parser.add_argument("--output", help="CSV file with a row per day")
+
+    args = parser.parse_args()
+
+    engine = PriceEngine()
+
+    if args.command == "backfill":
+        areas = args.area or [engine.area]
+        backfill(engine, args.first, args.last, areas, args.workers, args.rate)
+        return
+
+    if args.command == "backtest":
+        areas = args.area or [engine.area]
+        ratios = sum(args.ratio, []) if args.ratio else [engine.ratio]
+        policies = []
+        for mode in args.mode or [engine.mode]:
+            if mode == "fixed":
+                for price in args.price or [engine.fixed]:
+                    policies.append(Policy(mode, price, engine.ratio))
+            else:
+                for ratio in ratios:
+                    policies.append(
+                        Policy(
+                            mode,
+                            engine.fixed,
+                            ratio,
+                            engine.min_on,
+                            engine.max_switches,
+                        )
+                    )
+        run = (engine, args.first, args.last, areas, policies, args.power)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8", newline="") as file:
+                backtest(*run, args.workers, file)
+        else:
+            backtest(*run, args.workers, None)
+        return
+
+    if args.command == "replay":
+        run = (engine, args.first, args.last, args.synthetic, args.speed)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as file:
+                replay(*run, file)
+        else:
+            replay(*run, sys.stdout)
+        return
 
-    if mainwindow.mode == "fixed":
-        mainwindow.fixedprice()
+    engine.start_metrics()
+    engine.start_api()
 
-    if mainwindow.mode == "ratio":
-        mainwindow.ratioprice()
+    if args.headless:
+        run_headless(engine)
+        return
 
+    # Tk is only needed for the window, so headless boxes can run without it
+    from price_control_gui import MainWindowBuilder
+
+    mainwindow = MainWindowBuilder(engine)
+    mainwindow.title("Telldus Price Control " + VERSION)
+    # mainwindow.iconbitmap("sausage_icon_211243.ico")
     mainwindow.mainloop()
 
 
@@ -0,0 +1,654 @@
+# Telldus Price Control
+# By Conny Holm 2023
+
+# The Tk window. All control logic lives in PriceEngine in price_control.py,
+# this module only shows its state and passes the settings on to it.
+
+import tkinter as tk
+from tkinter import ttk, Listbox, Canvas
+from datetime import datetime
+import logging
+import queue
+import threading
+
+
+class IOWorker(threading.Thread):
+
+    # Runs the network calls of the window on a background thread. Finished
+    # jobs are put on a result queue that the Tk main loop polls with after(),
+    # so callbacks always run on the Tk thread and only touch memory.
+
+    def __init__(self, name="io", results=None):
+        super().__init__(name=name, daemon=True)
+        self.jobs = queue.Queue()
+        if results is None:
+            results = queue.Queue()
+        self.results = results
+
+    def submit(self, func, callback=None, *args):
+        self.jobs.put((func, args, callback))
+
+    def run(self):
+        while True:
+            func, args, callback = self.jobs.get()
+            try:
+                result = func(*args)
+            except Exception as e:
+                logging.error("Background job %s failed: %s", func.__name__, e)
+                result = None
+            if callback is not None:
+                self.results.put((callback, result))
+
+
+class MainWindowBuilder(tk.Tk):
+
+    def __init__(self, engine):
+        super().__init__()
+
+        logging.debug("Building main window")
+        self.engine = engine
+
+        self.scaling = None
+        self.loaded = False
+        self.tick_timer = None
+        self.settings_version = engine.settings_version
+
+        # what the price list shows right now
+        self.list_today = None
+        self.list_tomorrow = None
+        self.list_green = []
+        self.list_now = None
+        self.list_plans = None
+
+        self.io = IOWorker()
+        self.io.start()
+        # The device list has a worker of its own, so at startup it is
+        # fetched at the same time as the prices
+        self.lookup = IOWorker("lookup", self.io.results)
+        self.lookup.start()
+        self.after(100, self.poll_io)
+
+        # Create left frame with Telldus stuff
+        self.telldus = ttk.Labelframe(self, text="Telldus")
+
+        self.api_text = ttk.Label(self.telldus, text="Tellstick IP:")
+        self.api_entry = ttk.Entry(self.telldus)
+        self.api_entry.insert(0, self.engine.tell_api)
+
+        self.auth_text = ttk.Label(self.telldus, text="Authorization:")
+        self.auth_entry = ttk.Entry(self.telldus)
+        self.auth_entry.insert(0, self.engine.auth)
+
+        self.device_text = ttk.Label(self.telldus, text="Device:")
+        self.devicelist_text = ttk.Label(self.telldus, text="0 devices found")
+        self.device_combo = ttk.Combobox(self.telldus, state="readonly")
+        self.device_combo.insert(0, "No devices")
+        self.device_combo["values"] = ()
+        self.combo_ids = []
+        # self.device_combo['state'] = "READONLY"
+
+        self.telldus.grid(column=0, row=0, padx=5, pady=5, ipady=5, sticky="nw")
+        self.api_text.grid(column=0, row=0, sticky="w", padx=10, pady=4)
+        self.api_entry.grid(column=1, row=0, columnspan=2, padx=10, pady=4, ipadx=20)
+        self.auth_text.grid(column=0, row=1, sticky="w", padx=10, pady=4)
+        self.auth_entry.grid(column=1, row=1, columnspan=2, padx=10, pady=4, ipadx=20)
+
+        self.devicelist_text.grid(column=1, row=3, columnspan=2, pady=12)
+
+        self.device_text.grid(column=0, row=4, sticky="w", padx=10, pady=4)
+        self.device_combo.grid(column=1, row=4, columnspan=2, padx=0, pady=4, ipadx=12)
+
+        self.on = ttk.Button(self.telldus, text="Turn On", command=self.onbutton)
+        self.off = ttk.Button(self.telldus, text="Turn Off", command=self.offbutton)
+        self.on.grid(column=1, row=5, sticky="w", padx=8)
+        self.off.grid(column=1, row=6, sticky="w", padx=8)
+
+        self.add_btn = ttk.Button(self.telldus, text="Add", command=self.add_device)
+        self.refresh = ttk.Button(
+            self.telldus, text="Refresh", command=self.refresh_devices
+        )
+        self.add_btn.grid(column=2, row=5, sticky="e", padx=8)
+        self.refresh.grid(column=2, row=6, sticky="e", padx=8)
+
+        self.refresh_devices(False)
+
+        # List for prices
+        self.priceframe = ttk.Labelframe(self, text="Price list")
+        self.pricelist = Listbox(self.priceframe, height=24, width=40)
+
+        self.priceframe.grid(
+            column=2, row=0, padx=5, pady=5, ipady=6, rowspan=10, sticky="nw"
+        )
+        self.pricelist.grid(column=0, row=0, padx=4, pady=4)
+
+        # Scroll bar for price list
+        self.scrollbar = ttk.Scrollbar(self)
+        self.pricelist.config(yscrollcommand=self.scrollbar.set)
+        self.scrollbar.config(command=self.pricelist.yview)
+        self.scrollbar.grid(column=2, row=0, rowspan=48, sticky="nse")
+
+        # Price control
+        self.avgpriceframe = ttk.Labelframe(self, text="Price control")
+        self.arealabel = ttk.Label(self.avgpriceframe, text="Price area:")
+        self.areatext = ttk.Label(self.avgpriceframe, text=self.engine.area)
+        self.avgpricelabel = ttk.Label(self.avgpriceframe, text="Todays avg price:")
+        self.avgpricecalc = ttk.Label(self.avgpriceframe, text="Unknown")
+
+        self.avgpriceframe.grid(
+            column=3,
+            row=4,
+            padx=5,
+            pady=9,
+            ipady=10,
+            sticky="nw",
+            columnspan=1,
+            rowspan=6,
+        )
+        self.arealabel.grid(column=0, row=0, padx=2, pady=0, sticky="w")
+        self.areatext.grid(column=1, row=0, padx=2, pady=0, sticky="w")
+        self.avgpricelabel.grid(column=0, row=1, padx=10, pady=0, sticky="w")
+        self.avgpricecalc.grid(column=1, row=1, padx=10, pady=0, sticky="w")
+
+        # Radiobuttons
+
+        self.controltype = tk.StringVar(None, self.engine.mode)
+        self.pricefixed = ttk.Radiobutton(
+            self.avgpriceframe,
+            text="Fixed price",
+            variable=self.controltype,
+            value="fixed",
+            command=self.fixedprice,
+        )
+        self.priceratio = ttk.Radiobutton(
+            self.avgpriceframe,
+            text="Best hours",
+            variable=self.controltype,
+            value="ratio",
+            command=self.ratioprice,
+        )
+
+        self.priceblock = ttk.Radiobutton(
+            self.avgpriceframe,
+            text="Best block",
+            variable=self.controltype,
+            value="block",
+            command=self.ratioprice,
+        )
+
+        self.pricefixed.grid(column=0, row=2, padx=1, pady=0, sticky="w")
+        self.priceratio.grid(column=0, row=3, padx=1, pady=0, sticky="w")
+        self.priceblock.grid(column=0, row=4, padx=1, pady=0, sticky="w")
+
+        # Spinboxes
+        self.pricefixed_val = tk.StringVar(None, str(self.engine.fixed))
+        self.setfixed = ttk.Spinbox(
+            self.avgpriceframe,
+            from_=0.05,
+            to=99.0,
+            textvariable=self.pricefixed_val,
+            increment=0.05,
+            command=self.fixedprice,
+        )
+        self.priceratio_val = tk.StringVar(None, str(self.engine.ratio))
+        self.setratio = ttk.Spinbox(
+            self.avgpriceframe,
+            from_=1,
+            to=24,
+            textvariable=self.priceratio_val,
+            increment=1,
+            command=self.ratioprice,
+        )
+
+        self.setfixed.grid(column=1, row=2, sticky="e", ipadx=2)
+        self.setratio.grid(column=1, row=3, sticky="e", ipadx=2)
+
+        # checkbox for override
+        self.checkoverride_val = tk.StringVar(None, self.engine.override)
+        self.checkoverride = tk.Checkbutton(
+            self.avgpriceframe,
+            text="Override/Repeat",
+            variable=self.checkoverride_val,
+            onvalue="ON",
+            offvalue="OFF",
+        )
+        self.checkoverride.grid(column=0, row=5, sticky="w", padx=7, pady=4)
+
+        # Last updated
+        self.lastholder = ttk.Frame(self)
+        self.lastupdate = ttk.Label(self.lastholder, text="Last update: N/A")
+        self.lastholder.grid(column=4, row=6, padx=5, pady=0, sticky="nw", columnspan=1)
+        self.lastupdate.grid(column=0, row=0, padx=0, pady=0, sticky="nw")
+
+        # Last action
+        self.lastaction_label = ttk.Label(self.lastholder, text="Last action: N/A")
+        self.lastaction_label.grid(column=0, row=1, padx=0, pady=0, sticky="nw")
+
+        self.lastupdate["text"] = "Last update: Loading prices"
+
+        # List for devices to control
+        self.deviceframe = ttk.Labelframe(self, text="Devices to control")
+        self.devicelist = Listbox(self.deviceframe, height=8, width=45)
+        self.delete_btn = ttk.Button(
+            self.deviceframe, text="Remove selected", command=self.remove_device
+        )
+
+        self.deviceframe.grid(column=0, row=1, padx=5, pady=1, rowspan=8, sticky="nw")
+        self.devicelist.grid(column=0, row=0, padx=4, pady=4, ipadx=1)
+        self.delete_btn.grid(column=0, row=1, sticky="nw", padx=8, pady=8)
+
+        # Custom On commands
+        self.customonframe = ttk.Labelframe(self, text="Custom On command")
+        self.customonentry = ttk.Entry(self.customonframe)
+        self.customonframe.grid(column=4, row=4, padx=5, pady=9, sticky="nw")
+        self.customonentry.grid(column=0, row=0, padx=5, pady=5, ipadx=46, columnspan=1)
+        self.customonentry.insert(0, self.engine.oncommand)
+
+        # Custom Off commands
+        self.customoffframe = ttk.Labelframe(self, text="Custom Off command")
+        self.customoffentry = ttk.Entry(self.customoffframe)
+        self.customoffframe.grid(column=4, row=5, padx=5, pady=0, sticky="nw")
+        self.customoffentry.grid(
+            column=0, row=0, padx=5, pady=5, ipadx=46, columnspan=1
+        )
+        self.customoffentry.insert(0, self.engine.offcommand)
+
+        # Graph
+        self.graphheight = 230
+        self.graphwidth = 600
+        self.graphframe = ttk.Labelframe(self, text="Price graph")
+        self.graph = Canvas(
+            self.graphframe, height=self.graphheight, width=self.graphwidth, bg="white"
+        )
+
+        self.graphframe.grid(
+            column=3, row=0, padx=5, pady=5, rowspan=4, sticky="nw", columnspan=2
+        )
+        self.graph.grid(column=0, row=0, padx=4, pady=4)
+
+        # The graph items are created once and then moved and recoloured in
+        # place. Bars are only recreated when a new day is loaded.
+        self.graph.create_rectangle(
+            295, 0, 600, self.graphheight, fill="light gray", outline=""
+        )
+        self.graph_missing = self.graph.create_text(
+            400, 120, text="Tomorrows price\nnot yet available", fill="gray"
+        )
+        self.graph_line = self.graph.create_line(
+            0, 0, self.graphwidth, 0, width="2", fill="blue", state="hidden"
+        )
+        self.graph_today = None
+        self.graph_tomorrow = None
+        self.graph_bars = []
+        self.graph_fills = []
+        self.graph_drawn = None
+
+        self.populate_list()
+
+        self.io.submit(self.engine.load_prices, self.prices_loaded)
+
+    def poll_io(self):
+
+        # A failing callback is logged and the rest still run. The poll is
+        # always scheduled again, without it nothing would be controlled.
+        try:
+            while True:
+                try:
+                    callback, result = self.io.results.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    callback(result)
+                except Exception:
+                    logging.exception("Callback %s failed", callback.__name__)
+
+            # queued settings are applied by a tick, run one now
+            if self.engine.woken.is_set() and self.tick_timer is not None:
+                self.engine.woken.clear()
+                self.wake()
+        finally:
+            self.after(100, self.poll_io)
+
+    def prices_loaded(self, result):
+        self.loaded = True
+        self.redraw()
+        self.lastupdate["text"] = datetime.strftime(
+            datetime.now(), "Last update: %H:%M:%S"
+        )
+        self.timer_loop()
+        self.after(self.engine.delayseconds, self.resend_loop)
+
+    def sync_settings(self):
+
+        # Pass the values in the entries on to the engine
+        self.sync_settings_telldus()
+        self.engine.override = self.checkoverride_val.get()
+        self.engine.oncommand = self.customonentry.get()
+        self.engine.offcommand = self.customoffentry.get()
+
+    def sync_settings_telldus(self):
+        self.engine.tell_api = self.api_entry.get()
+        self.engine.auth = self.auth_entry.get()
+
+    def populate_list(self):
+        self.devicelist.delete(0, 666)
+        self.list_ids = []
+        for device in self.engine.controldevicelist.values():
+            self.devicelist.insert(0, device["id"] + " - " + device["name"])
+            self.list_ids.insert(0, device["id"])
+        return
+
+    def add_device(self):
+        device_id = self.combo_id()
+
+        if device_id is None:
+            return
+
+        self.engine.add_device(device_id)
+        self.populate_list()
+
+    def remove_device(self):
+        selected = self.devicelist.curselection()
+        if not selected:
+            return
+        device_id = self.list_ids[selected[0]]
+
+        self.engine.remove_device(device_id)
+        self.populate_list()
+
+    def fixedprice(self):
+        if self.controltype.get() == "fixed":
+            self.queue_settings(
+                lambda: {"mode": "fixed", "price": float(self.pricefixed_val.get())}
+            )
+        return
+
+    def ratioprice(self):
+        if self.controltype.get() in ("ratio", "block"):
+            self.queue_settings(
+                lambda: {
+                    "mode": self.controltype.get(),
+                    "ratio": int(self.priceratio_val.get()),
+                }
+            )
+        return
+
+    def queue_settings(self, read):
+
+        # The engine is only changed by a tick on the io thread, like changes
+        # from the API. poll_io runs that tick as soon as the io thread is
+        # free.
+        try:
+            self.engine.queue_settings(read())
+        except ValueError as e:
+            logging.error("Ignoring the setting: %s", e)
+
+    def refresh_devices(self, force=True):
+
+        # The Refresh button asks the TellStick, at start the registry may
+        # answer from its cache
+        self.sync_settings_telldus()
+        self.devicelist_text["text"] = "Searching..."
+        if force:
+            self.lookup.submit(self.engine.list_devices, self.devices_listed)
+        else:
+            self.lookup.submit(self.engine.known_devices, self.devices_listed)
+
+    def devices_listed(self, devices):
+
+        if devices is None:
+            self.devicelist_text["text"] = "No response."
+            self.device_combo.set("No devices")
+            self.device_combo["values"] = ""
+            self.combo_ids = []
+            return
+
+        if len(devices) > 0:
+            self.devicelist_text["text"] = str(len(devices)) + " devices found"
+            device_list = []
+            self.combo_ids = []
+
+            for device in devices:
+
+                device_list.append(device["id"] + " - " + device["name"])
+                self.combo_ids.append(device["id"])
+
+            self.device_combo.set("Select one")
+            self.device_combo["values"] = device_list
+        return
+
+    def combo_id(self):
+
+        # The id of the device picked in the combobox, None before one is picked
+        index = self.device_combo.current()
+        if index < 0 or index >= len(self.combo_ids):
+            return None
+        return self.combo_ids[index]
+
+    def onbutton(self):
+        device_id = self.combo_id()
+        if device_id is None:
+            return
+        logging.info("%s on", device_id)
+
+        self.sync_settings_telldus()
+        self.io.submit(self.engine.device_command, None, device_id, "turnOn")
+        return
+
+    def offbutton(self):
+        device_id = self.combo_id()
+        if device_id is None:
+            return
+        logging.info("%s off", device_id)
+
+        self.sync_settings_telldus()
+        self.io.submit(self.engine.device_command, None, device_id, "turnOff")
+        return
+
+    def timer_loop(self):
+
+        self.tick_timer = None
+        self.sync_settings()
+        self.io.submit(self.engine.tick, self.tick_done)
+
+    def tick_done(self, status):
+
+        if self.settings_version != self.engine.settings_version:
+            self.settings_version = self.engine.settings_version
+            self.controltype.set(self.engine.mode)
+            self.pricefixed_val.set(str(self.engine.fixed))
+            self.priceratio_val.set(str(self.engine.ratio))
+        self.redraw()
+
+        if status:
+            self.lastaction_label["text"] = "Last action: " + status
+        self.lastupdate["text"] = datetime.strftime(
+            datetime.now(), "Last update: %H:%M:%S"
+        )
+
+        # the next tick is at the start of the next price interval
+        delay = int(self.engine.next_wakeup() * 1000)
+        logging.debug("Waiting for %s milliseconds.", delay)
+        self.tick_timer = self.after(delay, self.timer_loop)
+
+    def wake(self):
+
+        # A setting changed, run a tick now instead of at the next interval.
+        # If a tick is already running it will pick up the change.
+        if self.tick_timer is None:
+            return
+        self.after_cancel(self.tick_timer)
+        self.timer_loop()
+
+    def resend_loop(self):
+
+        # Override/Repeat resends the last action every update interval
+        self.sync_settings()
+        if self.engine.override == "ON" and self.tick_timer is not None:
+            self.io.submit(self.engine.resend)
+        self.after(self.engine.delayseconds, self.resend_loop)
+
+    def redraw(self):
+        if not self.loaded:
+            return
+        self.update_price_list()
+        self.avgpricecalc["text"] = f"{self.engine.avgprice:.2f} SEK / KWh"
+        self.update_graph()
+
+    def price_row(self, series, index, now=False):
+        text = f"{series.labels[index]}    {series.prices[index]:.2f} SEK"
+        if now:
+            text += "    <-- Now"
+        return text
+
+    def update_price_list(self):
+
+        # The listbox keeps its rows between ticks. Rows are only rebuilt when
+        # a new day is loaded, tomorrows rows are appended once when they
+        # arrive, and after that only the "Now" marker and the colours of rows
+        # whose trigger changed are patched.
+        engine = self.engine
+        today = engine.todays_price
+        tomorrow = engine.tomorrows_price
+
+        if today is not self.list_today:
+            self.pricelist.delete(0, "end")
+            for index in range(len(today)):
+                self.pricelist.insert("end", self.price_row(today, index))
+            self.list_today = today
+            self.list_tomorrow = None
+            self.list_green = [False] * len(today)
+            self.list_now = None
+            self.list_plans = None
+
+        if tomorrow is not self.list_tomorrow:
+            self.pricelist.delete(len(today), "end")
+            del self.list_green[len(today):]
+            if tomorrow is not None:
+                for index in range(len(tomorrow)):
+                    self.pricelist.insert("end", self.price_row(tomorrow, index))
+                self.list_green += [False] * len(tomorrow)
+            self.list_tomorrow = tomorrow
+            self.list_plans = None
+
+        # Here we move the marker if the current time is in another entry
+        now_index = today.index_at(engine.clock() + engine.preroll)
+        if now_index != self.list_now:
+            for index, now in ((self.list_now, False), (now_index, True)):
+                if index is None:
+                    continue
+                self.pricelist.delete(index)
+                self.pricelist.insert(index, self.price_row(today, index, now))
+                if self.list_green[index]:
+                    self.pricelist.itemconfigure(index, background="#66ff66")
+            self.list_now = now_index
+
+        # Green rows are the entries the plan has the devices on
+        plans = (engine.plan_today, engine.plan_tomorrow)
+        if plans == self.list_plans:
+            return
+        self.list_plans = plans
+
+        days = ((today, plans[0], 0), (tomorrow, plans[1], len(today)))
+        for series, plan, offset in days:
+            if series is None or plan is None or len(plan) != len(series):
+                continue
+            for index, on in enumerate(plan):
+                self.colour_row(index + offset, bool(on))
+
+    def colour_row(self, index, green):
+        if self.list_green[index] == green:
+            return
+        self.list_green[index] = green
+        if green:
+            self.pricelist.itemconfigure(index, background="#66ff66")
+        else:
+            self.pricelist.itemconfigure(index, background="")
+
+    def update_graph(self):
+
+        engine = self.engine
+        today = engine.todays_price
+        tomorrow = engine.tomorrows_price
+
+        max_height = 0.9
+        if engine.highestprice != 0:
+            scaling = self.graphheight / engine.highestprice * max_height
+        else:
+            scaling = 100
+            logging.debug("Division by zero, setting scaling to 100")
+
+        # Nothing to do if neither the prices nor the plan changed
+        drawn = (
+            today,
+            tomorrow,
+            scaling,
+            engine.mode,
+            engine.triggerprice,
+            engine.plan_today,
+            engine.plan_tomorrow,
+        )
+        if drawn == self.graph_drawn:
+            return
+        rescale = scaling != self.scaling
+        self.scaling = scaling
+
+        if today is not self.graph_today or tomorrow is not self.graph_tomorrow:
+            for bar in self.graph_bars:
+                self.graph.delete(bar)
+            self.graph_bars = []
+            self.graph_fills = []
+            for offset, series in ((4, today), (300, tomorrow)):
+                # no bars for a day without prices
+                if not series:
+                    continue
+                spacing = int(300 / len(series))
+                bar_width = spacing - 1
+                for index in range(len(series)):
+                    bar_start_x = index * spacing + offset
+                    bar = self.graph.create_rectangle(
+                        bar_start_x, 0, bar_start_x + bar_width, 0, outline=""
+                    )
+                    self.graph_bars.append(bar)
+                    self.graph_fills.append(None)
+            self.graph.tag_raise(self.graph_line)
+            self.graph_today = today
+            self.graph_tomorrow = tomorrow
+            rescale = True
+
+        if not tomorrow:
+            self.graph.itemconfigure(self.graph_missing, state="normal")
+        else:
+            self.graph.itemconfigure(self.graph_missing, state="hidden")
+
+        # Loop for graph
+        bars = 0
+        days = ((today, engine.plan_today), (tomorrow, engine.plan_tomorrow))
+        for series, plan in days:
+            if not series:
+                continue
+            for index, price in enumerate(series.prices):
+                bar = self.graph_bars[bars]
+                if rescale:
+                    bar_start_x, _, bar_end_x, _ = self.graph.coords(bar)
+                    bar_start_y = self.graphheight - price * self.scaling
+                    self.graph.coords(
+                        bar, bar_start_x, bar_start_y, bar_end_x, self.graphheight
+                    )
+
+                if plan is not None and index < len(plan) and plan[index]:
+                    fill = "#66ff66"
+                else:
+                    fill = "red"
+                if fill != self.graph_fills[bars]:
+                    self.graph.itemconfigure(bar, fill=fill)
+                    self.graph_fills[bars] = fill
+                bars += 1
+
+        if engine.mode == "fixed":
+            starty = self.graphheight - engine.triggerprice * self.scaling
+            self.graph.coords(self.graph_line, 0, starty, self.graphwidth, starty)
+            self.graph.itemconfigure(self.graph_line, state="normal")
+        else:
+            self.graph.itemconfigure(self.graph_line, state="hidden")
+
+        self.graph_drawn = drawn
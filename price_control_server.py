@@ -0,0 +1,128 @@
+# Telldus Price Control
+# By Conny Holm 2023
+
+# The HTTP endpoints of Price Control. Like the window this module is only
+# imported when it is used, http.server is slow to import on a small box.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hmac
+import json
+import logging
+import threading
+
+# Bigger POST bodies are refused, settings are a few bytes
+MAX_BODY = 4096
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics request: " + format, *args)
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+
+    # The status API. GET answers are serialised by the engine when its state
+    # changes, here they are only looked up. A poller that sends the ETag back
+    # in If-None-Match gets 304 without a body. Keep-alive saves a poller the
+    # connection setup on every poll.
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        response = self.server.engine.responses.get(path)
+        if response is None:
+            self.reply(404, {"error": "Unknown path"}, "other")
+            return
+        etag, body = response
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.count(path, 304)
+            return
+        self.send_body(200, body, etag)
+        self.count(path, 200)
+
+    def do_POST(self):
+        path = self.path.split("?", 1)[0]
+
+        # The body is read before any answer. Left unread on a kept-alive
+        # connection, it would be taken for the start of the next request.
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if "Transfer-Encoding" in self.headers or not 0 <= length <= MAX_BODY:
+            self.close_connection = True
+            label = path if path == "/settings" else "other"
+            self.reply(400, {"error": "Expected a JSON body"}, label)
+            return
+        body = self.rfile.read(length)
+
+        if path != "/settings":
+            self.reply(404, {"error": "Unknown path"}, "other")
+            return
+
+        # With an API_TOKEN set, changes need it as a bearer token
+        token = self.server.engine.api_token
+        if token and not hmac.compare_digest(
+            self.headers.get("Authorization", "").encode("utf-8"),
+            ("Bearer " + token).encode("utf-8"),
+        ):
+            self.reply(401, {"error": "Wrong or missing token"}, path)
+            return
+
+        try:
+            changes = json.loads(body)
+            queued = self.server.engine.queue_settings(changes)
+        except ValueError as e:
+            self.reply(400, {"error": str(e)}, path)
+            return
+        self.reply(202, {"queued": queued}, path)
+
+    def reply(self, status, data, path):
+        self.send_body(status, json.dumps(data).encode("utf-8"))
+        self.count(path, status)
+
+    def count(self, path, status):
+        self.server.metrics.inc(
+            "price_control_api_requests_total", path=path, status=str(status)
+        )
+
+    def send_body(self, status, body, etag=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("API request: " + format, *args)
+
+
+def start_server(address, port, handler, name, **attributes):
+
+    # Serves handler from a daemon thread. attributes are set on the server,
+    # where the handler finds them as self.server.<name>.
+    server = ThreadingHTTPServer((address, port), handler)
+    server.daemon_threads = True
+    for key, value in attributes.items():
+        setattr(server, key, value)
+    threading.Thread(target=server.serve_forever, name=name, daemon=True).start()
+    return server
@@ -0,0 +1,191 @@
+# Telldus Price Control
+# Stand-ins for the TellStick and the price API, used by benchmark.py and
+# the replay command. Both are small HTTP servers running in a thread on
+# localhost.
+
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import json
+import math
+import random
+import threading
+import time
+
+from tzlocal import get_localzone
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    # Keep-alive like the real TellStick, so the dispatcher session is reused.
+    # Without Nagle the reply is not held back waiting for an ACK.
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        return
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TellStickHandler(StubHandler):
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if server.latency:
+            time.sleep(server.latency)
+
+        if url.path == "/api/devices/list":
+            self.reply(200, {"device": server.device_list()})
+            return
+
+        method = url.path.rsplit("/", 1)[-1]
+        if url.path.startswith("/api/device/") and method in ("turnOn", "turnOff"):
+            device_id = parse_qs(url.query).get("id", [""])[0]
+            if server.fails():
+                self.reply(500, {"error": "Stub failure"})
+                return
+            server.record(device_id, method)
+            self.reply(200, {"status": "success"})
+            return
+
+        self.reply(404, {"error": "Unknown path"})
+
+
+class StubTellStick(ThreadingHTTPServer):
+
+    # Answers the TellStick ZNet calls Price Control makes. Every command is
+    # recorded as (time, device id, method) and sets the state the device
+    # list reports. latency is seconds per request
+    # and failure_rate the share of commands that fail. clock gives the time
+    # stamps, so a replay can record its own time instead of the wall clock.
+
+    daemon_threads = True
+
+    def __init__(self, devices=10, latency=0.0, failure_rate=0.0, clock=time.time):
+        super().__init__(("127.0.0.1", 0), TellStickHandler)
+        self.devices = devices
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.clock = clock
+        self.commands = []
+        self.states = {}
+        self.lock = threading.Lock()
+        self.random = random.Random(1)
+        self.thread = None
+
+    @property
+    def address(self):
+        return "127.0.0.1:" + str(self.server_address[1])
+
+    def device_list(self):
+        with self.lock:
+            return [
+                {
+                    "id": index,
+                    "name": "Stub " + str(index),
+                    "methods": 3,
+                    "state": self.states.get(str(index), 2),
+                }
+                for index in range(1, self.devices + 1)
+            ]
+
+    def fails(self):
+        with self.lock:
+            return self.random.random() < self.failure_rate
+
+    def record(self, device_id, method):
+        with self.lock:
+            self.commands.append((self.clock(), device_id, method))
+            self.states[device_id] = 1 if method == "turnOn" else 2
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.serve_forever, name="stub-tellstick", daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class PriceAPIHandler(StubHandler):
+
+    def do_GET(self):
+
+        # /api/v1/prices/2023/01-15_SE3.json
+        try:
+            year, rest = self.path.split("/")[-2:]
+            month_day, area = rest[: -len(".json")].split("_")
+            month, day = month_day.split("-")
+            prices = self.server.day(int(year), int(month), int(day))
+        except ValueError:
+            self.reply(404, {"error": "Unknown path"})
+            return
+        self.server.requests += 1
+        self.reply(200, prices)
+
+
+class StubPriceAPI(ThreadingHTTPServer):
+
+    # Serves synthetic days with entries intervals each, 24 for hourly prices
+    # and 96 for quarters. Prices follow a sine wave like make_dummy_json.py.
+    # Intervals are laid out in epoch time from local midnight to midnight,
+    # so DST days get a few more or less of them, like the real API.
+
+    daemon_threads = True
+
+    def __init__(self, entries=96):
+        super().__init__(("127.0.0.1", 0), PriceAPIHandler)
+        self.entries = entries
+        self.requests = 0
+        self.thread = None
+
+    @property
+    def el_api(self):
+        return "http://127.0.0.1:" + str(self.server_address[1]) + "/api/v1/prices/"
+
+    def day(self, year, month, day):
+        local_tz = get_localzone()
+        start = datetime(year, month, day, tzinfo=local_tz).timestamp()
+        next_day = datetime(year, month, day) + timedelta(1)
+        end = next_day.replace(tzinfo=local_tz).timestamp()
+        step = 86400 / self.entries
+
+        prices = []
+        time_start = start
+        while time_start < end:
+            phase = 2 * math.pi * (time_start - start) / 86400
+            prices.append(
+                {
+                    "SEK_per_kWh": round(2.0 + 1.5 * math.sin(phase), 5),
+                    "time_start": datetime.fromtimestamp(
+                        time_start, local_tz
+                    ).isoformat(),
+                    "time_end": datetime.fromtimestamp(
+                        time_start + step, local_tz
+                    ).isoformat(),
+                }
+            )
+            time_start += step
+        return prices
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.serve_forever, name="stub-price-api", daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()